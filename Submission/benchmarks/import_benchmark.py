@@ -0,0 +1,104 @@
+"""
+Cold start of the app: every measurement runs in a fresh Python process, as on a new replica.
+
+"import" is the time to import streamlit_page once streamlit is loaded and the secrets are
+parsed (the server does both before the first page). "first page" is the first run of main.py
+through streamlit's AppTest, imports included. The heavy libraries loaded by then are listed,
+they should only be imported by generation and the exports.
+
+    python benchmarks/import_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, APP_DIR)
+
+from itinerary_benchmark import write_secrets
+
+HEAVY_MODULES = ('google.generativeai', 'google.api_core', 'reportlab', 'pygsheets', 'googleapiclient', 'google.oauth2', 'pandas', 'pycountry')
+
+CHILD = """
+import json, logging, sys, time, warnings
+sys.path.insert(0, {app_dir!r})
+warnings.filterwarnings('ignore')
+logging.disable(logging.WARNING)
+import streamlit as st
+st.secrets.load_if_toml_exists()
+start = time.perf_counter()
+if {mode!r} == 'import':
+    import streamlit_page
+else:
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file({main!r}, default_timeout=120)
+    at.run()
+    if at.exception:
+        raise SystemExit(at.exception[0].value)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def measure(mode, workdir):
+    code = CHILD.format(app_dir=APP_DIR, mode=mode, main=os.path.join(APP_DIR, 'main.py'), heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=workdir, capture_output=True, text=True)
+    if output.returncode:
+        raise SystemExit(output.stderr or output.stdout)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def slowest_imports(workdir, top):
+    # Cumulative import time of the app's own modules and what they pull in, from python -X importtime
+    code = f"import sys; sys.path.insert(0, {APP_DIR!r}); import streamlit as st; st.secrets.load_if_toml_exists(); import streamlit_page"
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=workdir, capture_output=True, text=True)
+    # Modules are listed after what they import, so streamlit_page's direct imports are the lines
+    # one level deeper just before it
+    lines = [line.split('|') for line in output.stderr.splitlines() if line.startswith('import time:')]
+    end = max(i for i, (_, _, name) in enumerate(lines) if name == ' streamlit_page')
+    modules = {}
+    for _, cumulative, name in reversed(lines[:end]):
+        if not name.startswith('   '):
+            break
+        if not name.startswith('    '):
+            modules[name.strip()] = int(cumulative) / 1e6
+    return sorted(modules.items(), key=lambda item: item[1], reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="fresh processes per measurement, the median is reported")
+    parser.add_argument('--top', type=int, default=10, help="slowest modules imported by streamlit_page to list")
+    parser.add_argument('--json', help="write the results to this file")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='triptailor-bench-')
+    write_secrets(workdir, {
+        'GOOGLE_API_KEY': 'benchmark',
+        'MAPS_API_KEY': 'benchmark',
+        'WEATHER': 'benchmark',
+        'CACHE_DIR': os.path.join(workdir, 'cache')
+    })
+
+    results = {}
+    for mode in ('import', 'first_page'):
+        runs = [measure(mode, workdir) for _ in range(options.repeat)]
+        results[mode] = {'median_s': round(statistics.median(run['elapsed'] for run in runs), 4),
+                         'min_s': round(min(run['elapsed'] for run in runs), 4),
+                         'heavy_modules_loaded': runs[-1]['loaded']}
+    results['slowest_imports'] = slowest_imports(workdir, options.top)
+
+    for mode in ('import', 'first_page'):
+        result = results[mode]
+        print(f"{mode:<10}  median {result['median_s']:.3f}s  min {result['min_s']:.3f}s  heavy modules loaded: {', '.join(result['heavy_modules_loaded']) or 'none'}")
+    print("slowest imports of streamlit_page:")
+    for name, seconds in results['slowest_imports']:
+        print(f"  {name:<40} {seconds:.3f}s")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
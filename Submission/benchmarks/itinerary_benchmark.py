@@ -0,0 +1,173 @@
+"""
+End-to-end benchmark of create_travel_itinerary and create_night_itinerary against local
+stand-ins for Gemini, Places, Distance Matrix and weatherapi.com (see stand_ins.py).
+
+Every trip length is run twice: "cold" with every cache empty, and "disk" with the in-memory
+st.cache_data layer cleared but the on-disk caches kept, as a freshly started replica would see.
+
+    python benchmarks/itinerary_benchmark.py --days 1,3,7 --night
+    python benchmarks/itinerary_benchmark.py --latency gemini=2,places=0.2 --jitter 0.05 --error-rate places=0.05
+    python benchmarks/itinerary_benchmark.py --secret GENERATION_MODE=multi_day --json results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from stand_ins import StandInServices, EndpointProfile, ENDPOINTS
+
+DEFAULT_LATENCY = {'gemini': 1.5, 'places': 0.15, 'geocode': 0.15, 'distancematrix': 0.2, 'weather': 0.2}
+
+def parse_endpoint_values(text, defaults=None):
+    values = dict(defaults or {})
+    for item in filter(None, (text or '').split(',')):
+        name, value = item.split('=')
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint '{name}', expected one of {', '.join(ENDPOINTS)}")
+        values[name] = float(value)
+    return values
+
+def parse_secret(text):
+    name, value = text.split('=', 1)
+    if value.lower() in ('true', 'false'):
+        return name, value.lower() == 'true'
+    try:
+        return name, int(value)
+    except ValueError:
+        return name, value
+
+def write_secrets(directory, secrets):
+    # st.secrets is read from .streamlit/secrets.toml in the working directory
+    os.makedirs(os.path.join(directory, '.streamlit'), exist_ok=True)
+    with open(os.path.join(directory, '.streamlit', 'secrets.toml'), 'w') as f:
+        for name, value in secrets.items():
+            f.write(f"{name} = {json.dumps(value)}\n")
+
+def quiet_streamlit():
+    # Running outside `streamlit run` logs a warning for every cached function. Streamlit resets
+    # its logger levels when the config is loaded, so the warning is filtered out instead
+    import logging
+    logging.getLogger('streamlit.runtime.caching.cache_data_api').addFilter(lambda record: 'No runtime found' not in record.getMessage())
+    warnings.filterwarnings('ignore', category=FutureWarning)
+
+def run_case(create_itineraries, services, trip, days, phase, night):
+    import streamlit as st
+    import disk_cache
+    import metrics
+    import http_client
+    from travel_estimate import estimator_accuracy
+    from singleflight import coalesced_stats
+    from rate_limit import limiter_stats
+
+    st.cache_data.clear()
+    if phase == 'cold':
+        for cache in disk_cache.caches.values():
+            cache.clear()
+    for cache in disk_cache.caches.values():
+        cache.reset_stats()
+    services.reset_counters()
+
+    start_date = datetime.date.today() + datetime.timedelta(days=1)
+    end_date = start_date + datetime.timedelta(days=days - 1)
+    args = (trip['destination'], trip['country'], start_date.isoformat(), end_date.isoformat(),
+            trip['hotel_name'], 'Vacation', 'driving', '')
+
+    result = {'case': f"{'night' if night else 'day'}-{phase}", 'days': days, 'error': None}
+    start = time.perf_counter()
+    with metrics.run_metrics(result['case']) as run:
+        try:
+            itineraries = create_itineraries(*args)
+            result['activities'] = sum(len(day['activities']) for itinerary in itineraries for day in itinerary)
+            result['days_generated'] = sum(len(itinerary) for itinerary in itineraries)
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+    result['wall_s'] = round(time.perf_counter() - start, 3)
+    result['stages'] = run.summary()
+    result['http'] = http_client.pool_stats()
+    result['estimator'] = estimator_accuracy()
+    result['coalesced'] = coalesced_stats()
+    result['rate_limits'] = limiter_stats()
+    result['calls'] = dict(services.calls)
+    result['injected_errors'] = dict(services.errors)
+    result['caches'] = {name: {'hits': stats['hits'], 'misses': stats['misses'], 'hit_rate': round(stats['hit_rate'], 3)}
+                        for name, stats in disk_cache.cache_stats().items()}
+    return result
+
+def print_results(results):
+    cache_names = sorted({name for result in results for name in result['caches']})
+    header = ['case', 'days', 'wall_s', *ENDPOINTS, *[f"{name}_hit" for name in cache_names], 'activities']
+    rows = [[
+        result['case'], result['days'], f"{result['wall_s']:.2f}",
+        *[str(result['calls'][name]) for name in ENDPOINTS],
+        *[f"{result['caches'].get(name, {}).get('hit_rate', 0):.0%}" for name in cache_names],
+        result['error'] or str(result.get('activities', ''))
+    ] for result in results]
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', default='1,3,7', help="comma separated trip lengths")
+    parser.add_argument('--night', action='store_true', help="also benchmark create_night_itinerary")
+    parser.add_argument('--fixture', default=os.path.join(BENCHMARK_DIR, 'fixtures', 'paris.json'))
+    parser.add_argument('--latency', help="per endpoint latency in seconds, e.g. gemini=2,places=0.2")
+    parser.add_argument('--jitter', type=float, default=0.0, help="uniform +/- jitter in seconds for every endpoint")
+    parser.add_argument('--error-rate', help="per endpoint error probability, e.g. places=0.05")
+    parser.add_argument('--secret', action='append', default=[], help="extra app setting, e.g. GENERATION_MODE=multi_day")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    options = parser.parse_args()
+    options.fixture = os.path.abspath(options.fixture)
+    options.json = options.json and os.path.abspath(options.json)
+
+    latency = parse_endpoint_values(options.latency, DEFAULT_LATENCY)
+    error_rate = parse_endpoint_values(options.error_rate)
+    profiles = {name: EndpointProfile(latency.get(name, 0.0), options.jitter, error_rate.get(name, 0.0)) for name in ENDPOINTS}
+    services = StandInServices(options.fixture, profiles, seed=options.seed).start()
+
+    workdir = tempfile.mkdtemp(prefix='triptailor-bench-')
+    write_secrets(workdir, {
+        'GOOGLE_API_KEY': 'benchmark',
+        'MAPS_API_KEY': 'benchmark',
+        'WEATHER': 'benchmark',
+        'MAPS_API_URL': f"{services.url}/maps/api",
+        'WEATHER_API_URL': f"{services.url}/weather/v1",
+        'GEMINI_API_ENDPOINT': services.url,
+        'GEMINI_TRANSPORT': 'rest',
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+        **dict(parse_secret(secret) for secret in options.secret)
+    })
+    os.chdir(workdir)
+
+    quiet_streamlit()
+    from create_itinerary import create_travel_itinerary, create_night_itinerary
+
+    with open(options.fixture, encoding='utf-8') as f:
+        trip = json.load(f)
+
+    kinds = [(create_travel_itinerary, False)]
+    if options.night:
+        kinds.append((create_night_itinerary, True))
+
+    results = []
+    for days in [int(days) for days in options.days.split(',')]:
+        for create_itineraries, night in kinds:
+            for phase in ('cold', 'disk'):
+                results.append(run_case(create_itineraries, services, trip, days, phase, night))
+
+    services.stop()
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'latency': latency, 'jitter': options.jitter, 'error_rate': error_rate, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
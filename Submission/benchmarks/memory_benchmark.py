@@ -0,0 +1,129 @@
+"""
+Memory held by generated itinerary sets in session state, as plain dicts and as the compact
+records of itinerary_model.py.
+
+Itineraries for 1 to --days day trips (day and night) are generated once against the stand-ins,
+then --sessions sessions each hold --sets of them. Every set is decoded from its own JSON copy,
+as it arrives from its generation job, so nothing is shared in the dict layout by accident.
+
+    python benchmarks/memory_benchmark.py --sessions 200 --sets 3
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from stand_ins import StandInServices, EndpointProfile, ENDPOINTS
+from itinerary_benchmark import write_secrets, quiet_streamlit
+
+def generate_payloads(trip, max_days):
+    # JSON of one itinerary set per trip length, as stored in the job results
+    import datetime
+    from create_itinerary import create_travel_itinerary, create_night_itinerary
+    payloads = []
+    for days in range(1, max_days + 1):
+        start_date = datetime.date.today() + datetime.timedelta(days=1)
+        end_date = start_date + datetime.timedelta(days=days - 1)
+        args = (trip['destination'], trip['country'], start_date.isoformat(), end_date.isoformat(),
+                trip['hotel_name'], 'Vacation', 'driving', '')
+        payloads.append(json.dumps({
+            'trip_details': {'destination': trip['destination'], 'country': trip['country'], 'start_date': args[2],
+                             'end_date': args[3], 'hotel_name': trip['hotel_name'], 'purpose_of_stay': 'Vacation',
+                             'mode_of_transport': '🚗 Driving'},
+            'day': create_travel_itinerary(*args),
+            'night': create_night_itinerary(*args)
+        }))
+    return payloads
+
+def dict_set(payload):
+    return json.loads(payload)
+
+def compact_set(payload):
+    from itinerary_model import compact_versions
+    itinerary_set = json.loads(payload)
+    itinerary_set['day'] = compact_versions(itinerary_set['day'])
+    itinerary_set['night'] = compact_versions(itinerary_set['night'])
+    return itinerary_set
+
+def measure(build, payloads, sessions, sets):
+    # Bytes still allocated once every session holds its sets
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = [[build(payloads[(session + i) % len(payloads)]) for i in range(sets)] for session in range(sessions)]
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return current - before, peak - before
+
+def check_compatible(payloads):
+    # The compact sets must render and export exactly like the dicts
+    from output import itinerary_markdown, generate_df
+    for payload in payloads:
+        plain, compact = dict_set(payload), compact_set(payload)
+        for part in ('day', 'night'):
+            for plain_version, compact_version in zip(plain[part], compact[part]):
+                if itinerary_markdown(plain_version, '🚗 Driving') != itinerary_markdown(compact_version, '🚗 Driving'):
+                    raise SystemExit(f"Markdown differs for a {part} version")
+        if not generate_df(plain).equals(generate_df(compact)):
+            raise SystemExit("generate_df differs")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--sets', type=int, default=3, help="itinerary sets held per session")
+    parser.add_argument('--days', type=int, default=7, help="longest trip generated")
+    parser.add_argument('--fixture', default=os.path.join(BENCHMARK_DIR, 'fixtures', 'paris.json'))
+    parser.add_argument('--json', help="write the results to this file")
+    options = parser.parse_args()
+    options.fixture = os.path.abspath(options.fixture)
+    options.json = options.json and os.path.abspath(options.json)
+
+    services = StandInServices(options.fixture, {name: EndpointProfile() for name in ENDPOINTS}).start()
+    workdir = tempfile.mkdtemp(prefix='triptailor-bench-')
+    write_secrets(workdir, {
+        'GOOGLE_API_KEY': 'benchmark',
+        'MAPS_API_KEY': 'benchmark',
+        'WEATHER': 'benchmark',
+        'MAPS_API_URL': f"{services.url}/maps/api",
+        'WEATHER_API_URL': f"{services.url}/weather/v1",
+        'GEMINI_API_ENDPOINT': services.url,
+        'GEMINI_TRANSPORT': 'rest',
+        'CACHE_DIR': os.path.join(workdir, 'cache')
+    })
+    os.chdir(workdir)
+
+    quiet_streamlit()
+
+    with open(options.fixture, encoding='utf-8') as f:
+        trip = json.load(f)
+    payloads = generate_payloads(trip, options.days)
+    services.stop()
+    check_compatible(payloads)
+
+    from itinerary_model import interned_places
+    results = {}
+    for layout, build in (('dict', dict_set), ('compact', compact_set)):
+        held, peak = measure(build, payloads, options.sessions, options.sets)
+        results[layout] = {'held_bytes': held, 'peak_bytes': peak, 'bytes_per_set': held // (options.sessions * options.sets)}
+    results['compact']['interned_places'] = interned_places()
+
+    sets = options.sessions * options.sets
+    print(f"{options.sessions} sessions x {options.sets} sets ({sets} sets, {len(payloads)} distinct trips)")
+    print(f"{'layout':<8}  {'held MB':>8}  {'peak MB':>8}  {'KB/set':>7}")
+    for layout, result in results.items():
+        print(f"{layout:<8}  {result['held_bytes'] / 2**20:8.1f}  {result['peak_bytes'] / 2**20:8.1f}  {result['bytes_per_set'] / 1024:7.1f}")
+    print(f"compact / dict: {results['compact']['held_bytes'] / results['dict']['held_bytes']:.1%}")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'sessions': options.sessions, 'sets': options.sets, 'trips': len(payloads), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Render time and peak memory of pdf_engine for a 1-day, a 7-day and a 3 x 7-day (every version
+of a set) document, built from the places in the fixture. No stand-ins or API keys are needed.
+
+"per call" builds the styles for every document as create_itinerary_pdf used to, "shared"
+reuses the process-wide templates, "pool" goes through the process pool and "cached" asks for
+a document that was already rendered.
+
+    python benchmarks/pdf_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from itinerary_benchmark import write_secrets, quiet_streamlit
+
+ACTIVITIES_PER_DAY = 6
+TIMES = ('09:00', '10:30', '12:30', '14:00', '16:00', '18:00')
+
+def fixture_itinerary(trip, days, offset=0):
+    # Days of activities cycling through the fixture places, in the shape verify_day returns
+    places = trip['day_places']
+    itinerary = []
+    for day in range(days):
+        activities = []
+        for i, time_text in enumerate(TIMES[:ACTIVITIES_PER_DAY]):
+            place = places[(offset + day * ACTIVITIES_PER_DAY + i) % len(places)]
+            activities.append({
+                'time': time_text,
+                'activity': f"Explore {place['name']} & its surroundings at a relaxed pace",
+                'place': {'name': place['name'], 'formatted_address': place['formatted_address'], 'url': ''},
+                'opening_hours': '09:00 AM - 06:00 PM',
+                'duration_to_next': f"{10 + i} mins",
+                'duration_to_next_value': 600 + 60 * i
+            })
+        weather = trip['weather_days'][day % len(trip['weather_days'])]
+        itinerary.append({'date': f"2025-06-{day + 1:02d}", 'weather': f"{weather['condition']['text']}: {weather['maxtemp_c']}°C (max), {weather['mintemp_c']}°C (min)", 'activities': activities})
+    return itinerary
+
+def documents(trip):
+    from pdf_engine import itinerary_rows
+    return {
+        '1 day': ("Itinerary 1 from Set 1", [(None, itinerary_rows(fixture_itinerary(trip, 1)))]),
+        '7 days': ("Itinerary 1 from Set 1", [(None, itinerary_rows(fixture_itinerary(trip, 7)))]),
+        '3 x 7 days': ("Itineraries from Set 1", [(f"Version {version} - Day", itinerary_rows(fixture_itinerary(trip, 7, offset=version)))
+                                                 for version in range(1, 4)])
+    }
+
+def timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), len(data)
+
+def peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="renders per measurement, the median is reported")
+    parser.add_argument('--fixture', default=os.path.join(BENCHMARK_DIR, 'fixtures', 'paris.json'))
+    parser.add_argument('--json', help="write the results to this file")
+    options = parser.parse_args()
+    options.fixture = os.path.abspath(options.fixture)
+    options.json = options.json and os.path.abspath(options.json)
+
+    workdir = tempfile.mkdtemp(prefix='triptailor-bench-')
+    write_secrets(workdir, {'PDF_WORKERS': 2})
+    os.chdir(workdir)
+    quiet_streamlit()
+    import pdf_engine
+
+    with open(options.fixture, encoding='utf-8') as f:
+        trip = json.load(f)
+
+    results = {}
+    pdf_engine.templates()
+    # Start the workers before timing, the first task pays for spawning them
+    pdf_engine.submit_pdf("warm up", [])[0].result()
+    for name, (title, sections) in documents(trip).items():
+        per_call, size = timed(lambda: pdf_engine.render(title, sections, pdf_engine.build_templates()), options.repeat)
+        shared, _ = timed(lambda: pdf_engine.render(title, sections), options.repeat)
+        pool, _ = timed(lambda: pdf_engine.pdf_executor().submit(pdf_engine.render, title, sections).result(), options.repeat)
+        pdf_engine.submit_pdf(title, sections)[0].result()
+        cached, _ = timed(lambda: pdf_engine.submit_pdf(title, sections)[0].result(), options.repeat)
+        results[name] = {
+            'pdf_bytes': size,
+            'per_call_s': round(per_call, 4),
+            'shared_s': round(shared, 4),
+            'pool_s': round(pool, 4),
+            'cached_s': round(cached, 6),
+            'peak_per_call_bytes': peak_memory(lambda: pdf_engine.render(title, sections, pdf_engine.build_templates())),
+            'peak_shared_bytes': peak_memory(lambda: pdf_engine.render(title, sections))
+        }
+
+    print(f"{'document':<11}  {'KB':>5}  {'per call s':>10}  {'shared s':>8}  {'pool s':>7}  {'cached ms':>9}  {'peak MB':>7}  {'peak shared MB':>14}")
+    for name, result in results.items():
+        print(f"{name:<11}  {result['pdf_bytes'] / 1024:5.0f}  {result['per_call_s']:10.3f}  {result['shared_s']:8.3f}  {result['pool_s']:7.3f}  "
+              f"{result['cached_s'] * 1000:9.3f}  {result['peak_per_call_bytes'] / 2**20:7.1f}  {result['peak_shared_bytes'] / 2**20:14.1f}")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+Local stand-ins for the Gemini, Places, Geocoding, Distance Matrix and weatherapi.com endpoints.
+
+Responses are built from a recorded fixture (see fixtures/), so the itinerary pipeline can run
+offline against realistic payloads. Every endpoint has its own latency, jitter and error rate,
+and the number of calls and injected errors is counted per endpoint.
+"""
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ENDPOINTS = ('gemini', 'places', 'geocode', 'distancematrix', 'weather')
+
+# Average door to door speeds in km/h and how much longer than a straight line the route is
+MODE_SPEEDS = {'driving': 22.0, 'walking': 4.8, 'bicycling': 14.0, 'transit': 18.0}
+ROUTE_DETOUR = 1.3
+
+DAY_TIMES = ['09:30', '11:30', '13:00', '15:00', '17:30']
+NIGHT_TIMES = ['22:00', '23:30', '01:00']
+
+class EndpointProfile:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self, rng):
+        return max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+
+def fold(text):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.casefold()).split())
+
+def stable_fraction(text, salt=''):
+    # Deterministic value in [0, 1) so synthesized answers are identical between runs
+    return int(hashlib.sha1((salt + text).encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+def format_duration(seconds):
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} min" if minutes == 1 else f"{minutes} mins"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} hour{'s' if hours > 1 else ''} {minutes} mins"
+
+class StandInServices:
+    def __init__(self, fixture_path, profiles=None, seed=0):
+        with open(fixture_path, encoding='utf-8') as f:
+            self.fixture = json.load(f)
+        profiles = profiles or {}
+        self.profiles = {name: profiles.get(name, EndpointProfile()) for name in ENDPOINTS}
+        self.calls = dict.fromkeys(ENDPOINTS, 0)
+        self.errors = dict.fromkeys(ENDPOINTS, 0)
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+        self.places_by_name = {}
+        self.coordinates = {}
+        for place in self.fixture['day_places'] + self.fixture['night_places']:
+            self.places_by_name[fold(place['name'])] = place
+            location = place['geometry']['location']
+            self.coordinates[fold(place['formatted_address'])] = (location['lat'], location['lng'])
+
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        services = self
+
+        class Handler(StandInHandler):
+            pass
+        Handler.services = services
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = dict.fromkeys(ENDPOINTS, 0)
+            self.errors = dict.fromkeys(ENDPOINTS, 0)
+
+    def record_call(self, endpoint):
+        # Counts the call and decides its latency and whether to inject an error
+        profile = self.profiles[endpoint]
+        with self._lock:
+            self.calls[endpoint] += 1
+            delay = profile.delay(self._rng)
+            failed = self._rng.random() < profile.error_rate
+            if failed:
+                self.errors[endpoint] += 1
+        return delay, failed
+
+    def place_coordinates(self, address):
+        if fold(address) in self.coordinates:
+            return self.coordinates[fold(address)]
+        # Unknown places are scattered within roughly 5 km of the city centre
+        location = self.fixture['location']
+        angle = stable_fraction(address, 'angle') * 2 * math.pi
+        radius = stable_fraction(address, 'radius') * 0.045
+        return location['lat'] + radius * math.sin(angle), location['lon'] + radius * math.cos(angle)
+
+    def places_response(self, query):
+        name = query.split(' in ')[0]
+        place = self.places_by_name.get(fold(name))
+        if place is None:
+            lat, lng = self.place_coordinates(name)
+            place = {
+                "name": name,
+                "formatted_address": f"{int(stable_fraction(name, 'number') * 150) + 1} Rue {name}, 75001 {self.fixture['destination']}, {self.fixture['country']}",
+                "rating": round(3.8 + stable_fraction(name, 'rating'), 1),
+                "user_ratings_total": int(50 + stable_fraction(name, 'reviews') * 5000),
+                "geometry": {"location": {"lat": lat, "lng": lng}}
+            }
+        return {"status": "OK", "results": [place]}
+
+    def distance_matrix_response(self, origins, destinations, mode):
+        speed = MODE_SPEEDS.get(mode, MODE_SPEEDS['driving'])
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                (lat1, lng1), (lat2, lng2) = self.place_coordinates(origin), self.place_coordinates(destination)
+                dx = (lng2 - lng1) * 111.32 * math.cos(math.radians((lat1 + lat2) / 2))
+                dy = (lat2 - lat1) * 110.57
+                distance = math.hypot(dx, dy) * ROUTE_DETOUR
+                duration = distance / speed * 3600
+                elements.append({
+                    "status": "OK",
+                    "distance": {"text": f"{distance:.1f} km", "value": int(distance * 1000)},
+                    "duration": {"text": format_duration(duration), "value": int(duration)}
+                })
+            rows.append({"elements": elements})
+        return {"status": "OK", "origin_addresses": origins, "destination_addresses": destinations, "rows": rows}
+
+    def weather_response(self, city, days):
+        today = datetime.date.today()
+        weather_days = self.fixture['weather_days']
+        return {
+            "location": dict(self.fixture['location'], name=city),
+            "forecast": {"forecastday": [
+                {"date": (today + datetime.timedelta(days=i)).isoformat(), "day": weather_days[i % len(weather_days)]}
+                for i in range(days)
+            ]}
+        }
+
+    def itinerary_day(self, date, day_number, itinerary_version, night):
+        pool = self.fixture['night_places' if night else 'day_places']
+        times = NIGHT_TIMES if night else DAY_TIMES
+        # Versions start a third of the pool apart, so longer trips overlap like real responses do
+        start = ((itinerary_version - 1) * len(pool) // 3 + (day_number - 1) * len(times)) % len(pool)
+        entries = {}
+        for i, activity_time in enumerate(times):
+            place = pool[(start + i) % len(pool)]
+            day = datetime.date.fromisoformat(date) + datetime.timedelta(days=1 if night and activity_time < '12:00' else 0)
+            time_int = int(datetime.datetime.combine(day, datetime.time.fromisoformat(activity_time)).timestamp())
+            entries[str(i + 1)] = {
+                "time": activity_time,
+                "activity": f"{'Drinks and music' if night else 'Visit'} at {place['name']}",
+                "place": place['name'],
+                "time_int": str(time_int),
+                "approx_distance": f"{1 + stable_fraction(place['name'], 'distance') * 5:.1f} kms"
+            }
+        return entries
+
+    def gemini_text(self, prompt):
+        night = 'nightlife' in prompt.lower()
+        version = re.search(r'version (\d+) of 3', prompt)
+        itinerary_version = int(version.group(1)) if version else 1
+
+        if 'for every day of a' in prompt or 'for every night of a' in prompt:
+            dates = re.findall(r'Day (\d+) \((\d{4}-\d{2}-\d{2})\)', prompt)
+            response = {date: self.itinerary_day(date, int(day_number), itinerary_version, night) for day_number, date in dates}
+        else:
+            date = re.search(r'Date: (\d{4}-\d{2}-\d{2})', prompt).group(1)
+            day_number = int(re.search(r'day (\d+) of a', prompt).group(1))
+            response = self.itinerary_day(date, day_number, itinerary_version, night)
+        return "```json\n" + json.dumps(response, indent=4) + "\n```"
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    services = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path.endswith('/place/textsearch/json'):
+            delay, failed = self.services.record_call('places')
+            time.sleep(delay)
+            if failed:
+                return self.send_json({"status": "OVER_QUERY_LIMIT", "results": []})
+            return self.send_json(self.services.places_response(query.get('query', '')))
+
+        if url.path.endswith('/geocode/json'):
+            delay, failed = self.services.record_call('geocode')
+            time.sleep(delay)
+            if failed:
+                return self.send_json({"status": "OVER_QUERY_LIMIT", "results": []})
+            location = self.fixture['location']
+            return self.send_json({"status": "OK", "results": [{"geometry": {"location": {"lat": location['lat'], "lng": location['lon']}}}]})
+
+        if url.path.endswith('/distancematrix/json'):
+            delay, failed = self.services.record_call('distancematrix')
+            time.sleep(delay)
+            if failed:
+                return self.send_json({"status": "OVER_QUERY_LIMIT", "rows": []})
+            return self.send_json(self.services.distance_matrix_response(
+                query.get('origins', '').split('|'), query.get('destinations', '').split('|'), query.get('mode', 'driving')))
+
+        if url.path.endswith('/forecast.json'):
+            delay, failed = self.services.record_call('weather')
+            time.sleep(delay)
+            if failed:
+                return self.send_json({"error": {"code": 9999, "message": "Internal application error."}}, status=503)
+            return self.send_json(self.services.weather_response(query.get('q', ''), int(query.get('days', 14))))
+
+        self.send_json({"error": "unknown endpoint"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        if ':generateContent' in url.path or ':streamGenerateContent' in url.path:
+            delay, failed = self.services.record_call('gemini')
+            if failed:
+                time.sleep(delay)
+                return self.send_json({"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}}, status=429)
+
+            prompt = "".join(part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', []))
+            text = self.services.gemini_text(prompt)
+            if ':streamGenerateContent' in url.path:
+                return self.stream_gemini(text, delay)
+            time.sleep(delay)
+            return self.send_json({"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}]})
+
+        if url.path.endswith('/forecast.json') and parse_qs(url.query).get('q') == ['bulk']:
+            # Bulk weather request, one call for every location in the body
+            delay, failed = self.services.record_call('weather')
+            time.sleep(delay)
+            if failed:
+                return self.send_json({"error": {"code": 9999, "message": "Internal application error."}}, status=503)
+            days = int(parse_qs(url.query).get('days', ['14'])[0])
+            return self.send_json({"bulk": [
+                {"query": {"custom_id": location.get('custom_id'), "q": location['q'], **self.services.weather_response(location['q'], days)}}
+                for location in body.get('locations', [])
+            ]})
+
+        self.send_json({"error": "unknown endpoint"}, status=404)
+
+    def stream_gemini(self, text, delay, chunk_count=8):
+        # The REST transport expects a JSON array of responses; the first chunk arrives after
+        # 30% of the latency and the rest are spread over the remainder, like token streaming
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        size = math.ceil(len(text) / chunk_count)
+        parts = [text[i:i + size] for i in range(0, len(text), size)]
+        time.sleep(delay * 0.3)
+        for i, part in enumerate(parts):
+            if i:
+                time.sleep(delay * 0.7 / len(parts))
+            response = {"candidates": [{"content": {"parts": [{"text": part}], "role": "model"}}]}
+            self.write_chunk(("[" if i == 0 else ",") + json.dumps(response))
+        self.write_chunk("]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
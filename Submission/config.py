@@ -0,0 +1,180 @@
+import streamlit as st
+import threading
+
+def flag(value):
+    # bool settings, also written as strings in the secrets: "1", "true", "yes", "on" and "0", "false", "no", "off", ""
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'on'):
+        return True
+    if text in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise ValueError(f"Expected true or false, got {value!r}")
+
+# Tunables read from st.secrets on first use (config.NAME), not when a module is imported: name -> (type, default).
+# A callable default is computed from other settings
+SETTINGS = {
+    # Gemini endpoint and transport, overridable to point at a local stand-in service (see benchmarks/)
+    'GEMINI_API_ENDPOINT': (str, ''),
+    'GEMINI_TRANSPORT': (str, ''),
+    # Times a Gemini call rejected for quota is retried, and the first and longest pause in seconds between tries
+    'GEMINI_QUOTA_RETRIES': (int, 4),
+    'GEMINI_QUOTA_BACKOFF': (float, 2),
+    'GEMINI_QUOTA_BACKOFF_MAX': (float, 30),
+    # Maximum number of Gemini calls / day verifications running at the same time
+    'GENERATION_WORKERS': (int, 6),
+    # Stream Gemini responses and start place lookups for each activity as soon as it is parsed
+    'GEMINI_STREAMING': (flag, False),
+    # "per_day" asks Gemini for every day separately, "multi_day" asks for a whole version in one call
+    'GENERATION_MODE': (str, 'per_day'),
+
+    # API base URLs, overridable to point at local stand-in services (see benchmarks/)
+    'MAPS_API_URL': (str, 'https://maps.googleapis.com/maps/api'),
+    'WEATHER_API_URL': (str, 'https://api.weatherapi.com/v1'),
+    # Sustained request rates the upstream quotas allow this process, and how many calls may go out back to back
+    'GEMINI_RPM': (float, 300),
+    'GEMINI_BURST': (int, 20),
+    'PLACES_QPS': (float, 50),
+    'DISTANCE_MATRIX_QPS': (float, 50),
+    'WEATHER_QPS': (float, 10),
+    # Maximum number of Places text searches in flight at once, shared by every session in the process
+    'PLACES_MAX_CONCURRENCY': (int, 8),
+    # Legs without a shared origin or destination sent per Distance Matrix request (see travel_time.py)
+    'DISTANCE_MATRIX_DIAGONAL_BATCH': (int, 1),
+    # Maximum number of Distance Matrix requests in flight at once, shared by every session in the process
+    'DISTANCE_MATRIX_MAX_CONCURRENCY': (int, 8),
+    # Places further than this from the geocoded destination centre are not considered within the destination,
+    # about the 2 hours by road the prompts allow. Matches inside it are preferred, outside ones are not dropped
+    'DESTINATION_RADIUS_KM': (float, 150),
+    # "off" always asks Distance Matrix, "fallback" estimates very short legs and legs the API could not
+    # answer, "primary" estimates every leg between places with known coordinates
+    'TRAVEL_ESTIMATOR': (str, 'fallback'),
+    # Legs shorter than this in a straight line are estimated without a request
+    'SHORT_LEG_KM': (float, 0.3),
+
+    # Seconds to wait for a connection and for each read, so a hung upstream cannot stall a session forever
+    'HTTP_CONNECT_TIMEOUT': (float, 3.05),
+    'HTTP_READ_TIMEOUT': (float, 30),
+    # Retries after the first attempt, with full-jitter exponential backoff capped at HTTP_BACKOFF_MAX seconds
+    'HTTP_RETRIES': (int, 3),
+    'HTTP_BACKOFF': (float, 0.5),
+    'HTTP_BACKOFF_MAX': (float, 8),
+    # Keep-alive connections kept per host, at least as many as lookups run in parallel
+    'HTTP_POOL_SIZE': (int, 16),
+
+    # Directory holding the on-disk caches and the job queue, shared by every process pointed at it
+    'CACHE_DIR': (str, '.cache'),
+    # Seconds each on-disk cache keeps an entry, and bytes of values it holds before evicting the least recently used
+    'PLACES_CACHE_TTL': (int, 30 * 24 * 3600),
+    'PLACES_CACHE_MAX_BYTES': (int, 64 * 1024 * 1024),
+    'PLACE_INDEX_MAX_BYTES': (int, 64 * 1024 * 1024),
+    'WEATHER_CACHE_TTL': (int, 3 * 3600),
+    'WEATHER_CACHE_MAX_BYTES': (int, 4 * 1024 * 1024),
+    'ITINERARY_CACHE_TTL': (int, 7 * 24 * 3600),
+    'ITINERARY_CACHE_MAX_BYTES': (int, 64 * 1024 * 1024),
+    'TRAVEL_TIME_CACHE_TTL': (int, 7 * 24 * 3600),
+    'TRAVEL_TIME_CACHE_MAX_BYTES': (int, 32 * 1024 * 1024),
+    # Seconds between two background refreshes of the forecasts users have read, 0 turns them off.
+    # Forecasts expiring before the next refresh are fetched again in bulk (a paid weatherapi.com plan)
+    'WEATHER_WARMUP_INTERVAL': (int, 1800),
+
+    # Worker threads started by this process, 0 leaves the jobs to separate worker processes (python jobs.py)
+    'JOB_WORKERS': (int, 2),
+    # Seconds between two looks at the queue by an idle worker, and between two polls by the page
+    'JOB_POLL_INTERVAL': (float, 1.0),
+    # Finished jobs are kept this long, submitting the same job again in the meantime returns the stored one
+    'JOB_TTL': (int, 3600),
+    # A running job whose worker has not sent a heartbeat for this long lost its worker and is queued again
+    'JOB_HEARTBEAT_TIMEOUT': (int, 300),
+
+    # SMTP server the itineraries are sent through. Without one, emails go through the Google Sheet and the Apps Script as before
+    'SMTP_HOST': (str, ''),
+    'SMTP_PORT': (int, 587),
+    'SMTP_USERNAME': (str, ''),
+    'SMTP_PASSWORD': (str, ''),
+    # starttls, ssl or none (e.g. a local debugging server)
+    'SMTP_SECURITY': (str, 'starttls'),
+    'SMTP_TIMEOUT': (float, 30),
+    'MAIL_FROM': (str, lambda: setting('SMTP_USERNAME') or 'TripTailor AI <noreply@localhost>'),
+    # Name of the transport in mailer.transports, or apps_script
+    'MAIL_TRANSPORT': (str, lambda: 'smtp' if setting('SMTP_HOST') else 'apps_script'),
+    # Sends retried by the outbox after a temporary failure, the delay doubles from OUTBOX_BACKOFF up to OUTBOX_BACKOFF_MAX seconds
+    'OUTBOX_RETRIES': (int, 5),
+    'OUTBOX_BACKOFF': (float, 10),
+    'OUTBOX_BACKOFF_MAX': (float, 300),
+    # Seconds to wait for the Apps Script's answer. It holds a script lock while it exports 3 PDFs and
+    # sends the email, which regularly takes longer than HTTP_READ_TIMEOUT, and the POST is not retried
+    'APPS_SCRIPT_TIMEOUT': (float, 360),
+
+    # Processes rendering PDFs, so a long document doesn't hold the GIL of the web process. 0 renders in the calling thread
+    'PDF_WORKERS': (int, 2),
+    # Rendered documents kept in memory by fingerprint
+    'PDF_CACHE_MAX_BYTES': (int, 64 * 1024 * 1024),
+
+    # Show per-stage timings of the last generation run in the sidebar (also enabled with ?debug=1)
+    'DEBUG_PANEL': (flag, False),
+    # Seconds between checks of the exports sent to Google Sheets and the mailer
+    'EXPORT_POLL_INTERVAL': (float, 1.0),
+}
+
+_secrets = {}
+_settings = {}
+_lock = threading.Lock()
+_genai = None
+
+def setting(name):
+    """The setting from st.secrets, or its default, cast to its type on first use and then kept for the process."""
+    try:
+        return _settings[name]
+    except KeyError:
+        cast, default = SETTINGS[name]
+        value = st.secrets.get(name)
+        if value is None:
+            value = default() if callable(default) else default
+        try:
+            _settings[name] = value = cast(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid {name} setting: {e}") from None
+        return value
+
+def __getattr__(name):
+    # config.NAME for every name in SETTINGS
+    if name in SETTINGS:
+        return setting(name)
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
+
+def secret(name):
+    """st.secrets[name], read on first use rather than when a module is imported, then kept for the process."""
+    value = _secrets.get(name)
+    if value is None:
+        value = _secrets[name] = st.secrets[name]
+    return value
+
+def google_api_key():
+    return secret('GOOGLE_API_KEY')
+
+def maps_api_key():
+    return secret('MAPS_API_KEY')
+
+def weather_api_key():
+    return secret('WEATHER')
+
+def gemini():
+    """
+    The google.generativeai module, imported and configured on first use, once per process.
+    Importing it takes longer than the rest of the app, and only generation needs it.
+    """
+    global _genai
+    if _genai is None:
+        with _lock:
+            if _genai is None:
+                import google.generativeai as genai
+                options = {}
+                if setting('GEMINI_TRANSPORT'):
+                    options['transport'] = setting('GEMINI_TRANSPORT')
+                if setting('GEMINI_API_ENDPOINT'):
+                    options['client_options'] = {'api_endpoint': setting('GEMINI_API_ENDPOINT')}
+                genai.configure(api_key=google_api_key(), **options)
+                _genai = genai
+    return _genai
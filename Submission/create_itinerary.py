@@ -1,205 +1,295 @@
 import streamlit as st
-import requests
-import pandas as pd
-import google.generativeai as genai
 import time
-GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
-genai.configure(api_key=GOOGLE_API_KEY)
-google_places_api_key = st.secrets['MAPS_API_KEY']
-weather_api_key = st.secrets['WEATHER']
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-from place_weather import get_place_details, get_weather_forecast
-from get_itinerary import get_daily_itinerary, get_nightlife_itinerary, get_place_opening_hours
+# Number of itinerary versions generated per trip
+ITINERARY_VERSIONS = 3
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def create_travel_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences):
-    weather_forecast_data = get_weather_forecast(destination)
-    num_days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
-    all_itineraries = []
-    start_date_dt = pd.to_datetime(start_date)
-    all_used_places = set()  # Track used places across all itineraries
+from place_weather import get_places_details, submit_place_lookup, get_weather_index, get_weather_summary
+from get_itinerary import get_daily_itinerary, get_nightlife_itinerary, stream_daily_itinerary, stream_nightlife_itinerary, get_multi_day_itinerary, get_multi_night_itinerary
+from opening_hours import display_hours, check_activities
+from travel_time import get_travel_times
+from place_index import place_coordinates
+from rate_limit import INTERACTIVE, BACKGROUND, with_priority
+import config
+import metrics
+import jobs
+
+def place_query(place, destination, country):
+    return f"{place} in {destination}, {country}"
 
-    for itinerary_version in range(3):
-        itinerary = []
-        used_places = set()  # Track used places for this itinerary
+def reserve_places(daily_itinerary, all_used_places):
+    # Keep the first occurrence of every place, skipping places used by earlier days or versions
+    reserved = []
+    for item in daily_itinerary.values():
+        if item['place'] in all_used_places:
+            continue
+        all_used_places.add(item['place'])
+        reserved.append(item)
+    return reserved
 
-        for day in range(num_days):
-            current_date = (start_date_dt + pd.Timedelta(days=day)).strftime('%Y-%m-%d')
+def add_travel_times(verified_itinerary, current_date, mode_of_transport, night=False):
+    legs, coordinates = [], []
+    for i in range(len(verified_itinerary) - 1):
+        origin = verified_itinerary[i]['place']['formatted_address']
+        next_stop = verified_itinerary[i + 1]['place']['formatted_address']
+        act_time = verified_itinerary[i + 1]['time']
+        date_time = current_date+' '+act_time+':00'
+        pattern = '%Y-%m-%d %H:%M:%S'
+        epoch = int(time.mktime(time.strptime(date_time, pattern)))
+        legs.append((origin, next_stop, epoch))
+        coordinates.append((place_coordinates(verified_itinerary[i]['place']), place_coordinates(verified_itinerary[i + 1]['place'])))
 
-            weather_summary = next((day['day'] for day in weather_forecast_data['forecast']['forecastday'] if day['date'] == current_date), None)
-            if weather_summary:
-                weather_summary = f"{weather_summary['condition']['text']}: {weather_summary['maxtemp_c']}°C (max), {weather_summary['mintemp_c']}°C (min)"
+    # All legs of the day are looked up together
+    for i, (status, element) in enumerate(get_travel_times(legs, mode_of_transport, coordinates)):
+        if status == "OK":
+            if element and element.get("status") == "OK":
+                if "duration" in element:
+                    duration = element["duration"]["text"]
+                    duration_value = element["duration"]["value"]
+
+                    # Check if the duration is very short (less than 2 minutes)
+                    if not night and duration_value < 120:
+                        verified_itinerary[i]['duration_to_next'] = "Nearby"
+                        verified_itinerary[i]['duration_to_next_value'] = 0
+                    else:
+                        verified_itinerary[i]['duration_to_next'] = duration
+                        verified_itinerary[i]['duration_to_next_value'] = duration_value
+                elif night:
+                    verified_itinerary[i]['duration_to_next'] = "Unable to calculate duration"
+                    verified_itinerary[i]['duration_to_next_value'] = float('inf')
+                else:
+                    verified_itinerary[i]['duration_to_next'] = "Nearby"
+                    verified_itinerary[i]['duration_to_next_value'] = 0
+            elif night:
+                verified_itinerary[i]['duration_to_next'] = "Route not found"
+                verified_itinerary[i]['duration_to_next_value'] = float('inf')
             else:
-                weather_summary = "Weather data not available"
+                verified_itinerary[i]['duration_to_next'] = "Nearby"
+                verified_itinerary[i]['duration_to_next_value'] = 0
+        else:
+            verified_itinerary[i]['duration_to_next'] = f"API Error: {status}"
+            verified_itinerary[i]['duration_to_next_value'] = float('inf')
 
-            daily_itinerary = get_daily_itinerary(destination, country, current_date, hotel_name, purpose_of_stay, weather_summary, day + 1, num_days, all_used_places, mode_of_transport, custom_preferences)
+    # Set the last activity's duration to "N/A" only if there are activities
+    if verified_itinerary:
+        verified_itinerary[-1]['duration_to_next'] = "N/A"
+        verified_itinerary[-1]['duration_to_next_value'] = 0
 
-            if daily_itinerary is None:
-                # print(f"Error: Failed to get itinerary from GeminiAI for {current_date}")
-                continue
+def verify_day(items, destination, country, current_date, weather_summary, mode_of_transport, night=False, place_lookups=None):
+    verified_itinerary = []
+    location = f"{destination}, {country}"
+    queries = [place_query(item['place'], destination, country) for item in items]
 
-            verified_itinerary = []
-            for item in daily_itinerary.values():
-                if item['place'] in all_used_places:
-                    # print(f"Skipping repeated place: {item['place']}")
-                    continue
-
-                place_details = get_place_details(f"{item['place']} in {destination}, {country}", f"{destination}, {country}")
-                selected_place = place_details
-                opening_hours = get_place_opening_hours(selected_place, current_date)
-                verified_itinerary.append({
-                    'time': item['time'],
-                    'activity': item['activity'],
-                    'place': selected_place,
-                    'opening_hours': opening_hours,
-                    'time_int': item['time_int'],
-                    'approx_distance': item['approx_distance']
-                })
-                all_used_places.add(item['place'])  # Add to all used places
-                used_places.add(item['place'])
-
-            # Only process travel times if there are activities
-            if verified_itinerary:
-                for i in range(len(verified_itinerary) - 1):
-                    origin = verified_itinerary[i]['place']['formatted_address']
-                    destination = verified_itinerary[i + 1]['place']['formatted_address']
-                    act_time = verified_itinerary[i + 1]['time']
-                    date_time = current_date+' '+act_time+':00'
-                    pattern = '%Y-%m-%d %H:%M:%S'
-                    epoch = int(time.mktime(time.strptime(date_time, pattern)))
-                    url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={origin}&destinations={destination}&mode={mode_of_transport}&key={google_places_api_key}&departure_time={epoch}"
-                    response = requests.get(url)
-                    distance_data = response.json()
-
-                    if distance_data["status"] == "OK":
-                        if (distance_data.get("rows") and
-                            distance_data["rows"][0].get("elements") and
-                            distance_data["rows"][0]["elements"][0].get("status") == "OK"):
-
-                            element = distance_data["rows"][0]["elements"][0]
-                            if "duration" in element:
-                                duration = element["duration"]["text"]
-                                duration_value = element["duration"]["value"]
-                                
-                                # Check if the duration is very short (less than 2 minutes)
-                                if duration_value < 120:
-                                    verified_itinerary[i]['duration_to_next'] = "Nearby"
-                                    verified_itinerary[i]['duration_to_next_value'] = 0
-                                else:
-                                    verified_itinerary[i]['duration_to_next'] = duration
-                                    verified_itinerary[i]['duration_to_next_value'] = duration_value
-                            else:
-                                verified_itinerary[i]['duration_to_next'] = "Nearby"
-                                verified_itinerary[i]['duration_to_next_value'] = 0
-                        else:
-                            verified_itinerary[i]['duration_to_next'] = "Nearby"
-                            verified_itinerary[i]['duration_to_next_value'] = 0
-                    else:
-                        verified_itinerary[i]['duration_to_next'] = f"API Error: {distance_data['status']}"
-                        verified_itinerary[i]['duration_to_next_value'] = float('inf')
+    # Places already being looked up while the response streamed in are not requested again
+    place_lookups = place_lookups or {}
+    missing = [query for query in queries if query not in place_lookups]
+    found = dict(zip(missing, get_places_details(missing, location)))
+    places = [place_lookups[query].result() if query in place_lookups else found[query] for query in queries]
 
-                # Set the last activity's duration to "N/A" only if there are activities
-                verified_itinerary[-1]['duration_to_next'] = "N/A"
-                verified_itinerary[-1]['duration_to_next_value'] = 0
+    for item, place_details in zip(items, places):
+        opening_hours = display_hours(place_details, current_date)
+        verified_itinerary.append({
+            'time': item['time'],
+            'activity': item['activity'],
+            'place': place_details,
+            'opening_hours': opening_hours,
+            'time_int': item['time_int'],
+            'approx_distance': item['approx_distance']
+        })
 
-            itinerary.append({
-                'date': current_date,
-                'weather': weather_summary,
-                'activities': verified_itinerary
-            })
+    # Flag activities planned while the place is closed, after midnight for nightlife counts as the next day
+    for activity, open_at_visit in zip(verified_itinerary, check_activities(verified_itinerary, current_date, night)):
+        activity['open_at_visit'] = open_at_visit
 
-        all_itineraries.append(itinerary)
-    return all_itineraries
+    # Only process travel times if there are activities
+    add_travel_times(verified_itinerary, current_date, mode_of_transport, night)
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def create_night_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences):
-    weather_forecast_data = get_weather_forecast(destination)
-    num_days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
-    all_itineraries = []
-    start_date_dt = pd.to_datetime(start_date)
-    all_used_places = set()  # Track used places across all itineraries
+    return {
+        'date': current_date,
+        'weather': weather_summary,
+        'activities': verified_itinerary
+    }
+
+def request_itinerary(get_itinerary, *args):
+    return get_itinerary(*args), {}
+
+def stream_itinerary_with_places(stream_itinerary, destination, country, *args):
+    # Start each place lookup as soon as its activity has been streamed
+    daily_itinerary, place_lookups = {}, {}
+    for key, item in stream_itinerary(destination, country, *args):
+        daily_itinerary[key] = item
+        query = place_query(item['place'], destination, country)
+        if query not in place_lookups:
+            place_lookups[query] = submit_place_lookup(query, f"{destination}, {country}")
+    return daily_itinerary or None, place_lookups
+
+def request_day_from_version(version_days, date, fetch_itinerary, get_itinerary, *args):
+    # Take the day from its version's multi-day response, regenerating it alone if it failed validation
+    daily_itinerary = version_days.get(date) if version_days else None
+    if daily_itinerary is None:
+        return fetch_itinerary(get_itinerary, *args)
+    return daily_itinerary, {}
 
-    for itinerary_version in range(3):
-        itinerary = []
-        used_places = set()  # Track used places for this itinerary
+def add_used_places(used_places, daily_itinerary):
+    for item in (daily_itinerary or {}).values():
+        if item['place'] not in used_places:
+            used_places.append(item['place'])
 
-        for day in range(num_days):
-            current_date = (start_date_dt + pd.Timedelta(days=day)).strftime('%Y-%m-%d')
+def generate_version(day_responses, fetch, get_multi_day, stopped, destination, country, dates, hotel_name, purpose_of_stay, weather_summaries, itinerary_version, mode_of_transport, custom_preferences):
+    """
+    Generate the days of one version in date order, setting each day's future as soon as Gemini
+    has answered. Every prompt lists the places of the version's earlier days, so they are not
+    suggested again. With get_multi_day, the whole version is asked for first and only the days
+    failing validation are generated alone, avoiding every place of the version. Once stopped()
+    is true, the remaining days are cancelled instead of requested.
+    """
+    fetch_itinerary, get_itinerary = fetch
+    used_places = []
+    version_days = None
+    if get_multi_day is not None:
+        try:
+            version_days = get_multi_day(destination, country, tuple(dates), hotel_name, purpose_of_stay, tuple(weather_summaries), itinerary_version, mode_of_transport, custom_preferences)
+        except Exception as e:
+            print(f"Error: Failed to get multi-day itinerary from GeminiAI: {e}")
+        for daily_itinerary in (version_days or {}).values():
+            add_used_places(used_places, daily_itinerary)
 
-            weather_summary = next((day['day'] for day in weather_forecast_data['forecast']['forecastday'] if day['date'] == current_date), None)
-            if weather_summary:
-                weather_summary = f"{weather_summary['condition']['text']}: {weather_summary['maxtemp_c']}°C (max), {weather_summary['mintemp_c']}°C (min)"
+    for day, response in enumerate(day_responses):
+        if stopped is not None and stopped():
+            for pending in day_responses[day:]:
+                pending.cancel()
+            return
+        # Cancelled when the caller stopped reading
+        if not response.set_running_or_notify_cancel():
+            return
+        args = (destination, country, dates[day], hotel_name, purpose_of_stay, weather_summaries[day], day + 1, len(dates), itinerary_version, tuple(used_places), mode_of_transport, custom_preferences)
+        try:
+            if get_multi_day is not None:
+                result = request_day_from_version(version_days, dates[day], fetch_itinerary, get_itinerary, *args)
             else:
-                weather_summary = "Weather data not available"
+                result = fetch_itinerary(get_itinerary, *args)
+            add_used_places(used_places, result[0])
+        except Exception as e:
+            response.set_exception(e)
+            continue
+        response.set_result(result)
 
-            daily_itinerary = get_nightlife_itinerary(destination, country, current_date, hotel_name, purpose_of_stay, weather_summary, day + 1, num_days, all_used_places, mode_of_transport, custom_preferences)
+def version_priority(itinerary_version, night):
+    # The first day version is what the user reads first, the other versions and nightlife can wait for quota
+    return INTERACTIVE if itinerary_version == 0 and not night else BACKGROUND
 
+def iter_itineraries(get_itinerary, destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, night=False, max_workers=None, stream_itinerary=None, get_multi_day=None, stopped=None):
+    """
+    Generate all itinerary versions concurrently, yielding (version_index, day_index, day)
+    for every day as soon as its places and travel times are verified. The days of a version are
+    requested one after the other, so each prompt can exclude the places of the days before it.
+    When stream_itinerary is given, Gemini responses are streamed and place lookups overlap with
+    generation. When get_multi_day is given, each version is requested in a single call and
+    get_itinerary is only used for the days that fail validation. stopped() is checked before every
+    Gemini call and every verification, generation ends early once it returns true (e.g. the job
+    was cancelled).
+    """
+    weather_index = get_weather_index(destination)
+    start_date_dt = datetime.strptime(start_date, '%Y-%m-%d')
+    num_days = (datetime.strptime(end_date, '%Y-%m-%d') - start_date_dt).days + 1
+    dates = [(start_date_dt + timedelta(days=day)).strftime('%Y-%m-%d') for day in range(num_days)]
+    weather_summaries = [get_weather_summary(weather_index, current_date) for current_date in dates]
+    all_used_places = set()  # Track used places across all itineraries
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or config.GENERATION_WORKERS)
+    responses = []
+    try:
+        if stream_itinerary is not None:
+            fetch = (stream_itinerary_with_places, stream_itinerary)
+        else:
+            fetch = (request_itinerary, get_itinerary)
+        # One task per version generates its days in order, the versions run side by side
+        for itinerary_version in range(ITINERARY_VERSIONS):
+            day_responses = [Future() for _ in range(num_days)]
+            metrics.submit(executor, with_priority, version_priority(itinerary_version, night), generate_version, day_responses, fetch, get_multi_day, stopped,
+                           destination, country, dates, hotel_name, purpose_of_stay, weather_summaries, itinerary_version + 1, mode_of_transport, custom_preferences)
+            responses.extend((itinerary_version, day, response) for day, response in enumerate(day_responses))
+
+        # Responses are consumed in version/day order, so the places reserved by each
+        # day do not depend on which Gemini call happened to finish first
+        verifying = {}
+        for itinerary_version, day, response in responses:
+            # Hand out verified days while waiting for the next response in order
+            while not response.done():
+                done, _ = wait([response, *verifying], return_when=FIRST_COMPLETED)
+                for verified in done.intersection(verifying):
+                    yield (*verifying.pop(verified), verified.result())
+
+            if response.cancelled() or (stopped is not None and stopped()):
+                return
+            daily_itinerary, place_lookups = response.result()
             if daily_itinerary is None:
-                print(f"Error: Failed to get itinerary from GeminiAI for {current_date}")
+                print(f"Error: Failed to get itinerary from GeminiAI for {dates[day]}")
                 continue
 
-            verified_itinerary = []
-            for item in daily_itinerary.values():
-                if item['place'] in all_used_places:
-                    continue
-
-                place_details = get_place_details(f"{item['place']} in {destination}, {country}", f"{destination}, {country}")
-                selected_place = place_details
-                opening_hours = get_place_opening_hours(selected_place, current_date)
-                verified_itinerary.append({
-                    'time': item['time'],
-                    'activity': item['activity'],
-                    'place': place_details,
-                    'opening_hours': opening_hours,
-                    'time_int': item['time_int'],
-                    'approx_distance': item['approx_distance']
-                })
-                all_used_places.add(item['place'])  # Add to all used places
-                used_places.add(item['place'])
-
-            # Only process travel times if there are activities
-            if verified_itinerary:
-                for i in range(len(verified_itinerary) - 1):
-                    origin = verified_itinerary[i]['place']['formatted_address']
-                    destination = verified_itinerary[i + 1]['place']['formatted_address']
-                    act_time = verified_itinerary[i + 1]['time']
-                    date_time = current_date+' '+act_time+':00'
-                    pattern = '%Y-%m-%d %H:%M:%S'
-                    epoch = int(time.mktime(time.strptime(date_time, pattern)))
-                    url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={origin}&destinations={destination}&mode={mode_of_transport}&key={google_places_api_key}&departure_time={epoch}"
-                    response = requests.get(url)
-                    distance_data = response.json()
-
-                    if distance_data["status"] == "OK":
-                        if (distance_data.get("rows") and
-                            distance_data["rows"][0].get("elements") and
-                            distance_data["rows"][0]["elements"][0].get("status") == "OK"):
-
-                            element = distance_data["rows"][0]["elements"][0]
-                            if "duration" in element:
-                                duration = element["duration"]["text"]
-                                duration_value = element["duration"]["value"]
-                                verified_itinerary[i]['duration_to_next'] = duration
-                                verified_itinerary[i]['duration_to_next_value'] = duration_value
-                            else:
-                                verified_itinerary[i]['duration_to_next'] = "Unable to calculate duration"
-                                verified_itinerary[i]['duration_to_next_value'] = float('inf')
-                        else:
-                            verified_itinerary[i]['duration_to_next'] = "Route not found"
-                            verified_itinerary[i]['duration_to_next_value'] = float('inf')
-                    else:
-                        verified_itinerary[i]['duration_to_next'] = f"API Error: {distance_data['status']}"
-                        verified_itinerary[i]['duration_to_next_value'] = float('inf')
+            items = reserve_places(daily_itinerary, all_used_places)
+            verified = metrics.submit(executor, with_priority, version_priority(itinerary_version, night), verify_day, items, destination, country, dates[day], weather_summaries[day], mode_of_transport, night, place_lookups)
+            verifying[verified] = (itinerary_version, day)
+
+        for verified in as_completed(list(verifying)):
+            yield (*verifying.pop(verified), verified.result())
+    finally:
+        # Cancelling the day futures stops the version tasks before their next Gemini call
+        for _, _, response in responses:
+            response.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_travel_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, stopped=None):
+    return iter_itineraries(get_daily_itinerary, destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, stopped=stopped,
+                            stream_itinerary=stream_daily_itinerary if config.GEMINI_STREAMING else None,
+                            get_multi_day=get_multi_day_itinerary if config.GENERATION_MODE == 'multi_day' else None)
 
-                # Set the last activity's duration to "N/A" only if there are activities
-                verified_itinerary[-1]['duration_to_next'] = "N/A"
-                verified_itinerary[-1]['duration_to_next_value'] = 0
+def iter_night_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, stopped=None):
+    return iter_itineraries(get_nightlife_itinerary, destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, night=True, stopped=stopped,
+                            stream_itinerary=stream_nightlife_itinerary if config.GEMINI_STREAMING else None,
+                            get_multi_day=get_multi_night_itinerary if config.GENERATION_MODE == 'multi_day' else None)
+
+def collect_itineraries(days):
+    # Arrange (version_index, day_index, day) results into per-version lists of days in date order
+    versions = [{} for _ in range(ITINERARY_VERSIONS)]
+    for itinerary_version, day, verified_day in days:
+        versions[itinerary_version][day] = verified_day
+    return [[version[day] for day in sorted(version)] for version in versions]
+
+@st.cache_data(ttl=3600,show_spinner=False)
+def create_travel_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences):
+    return collect_itineraries(iter_travel_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences))
+
+@st.cache_data(ttl=3600,show_spinner=False)
+def create_night_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences):
+    return collect_itineraries(iter_night_itinerary(destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences))
 
-            itinerary.append({
-                'date': current_date,
-                'weather': weather_summary,
-                'activities': verified_itinerary
-            })
+@jobs.handler('itineraries')
+def generate_itineraries(job, destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences, nightlife):
+    """
+    Background job generating one itinerary set. Progress is {"day": [...], "night": [...]} with the
+    [version_index, day_index, day] entries verified so far, so the page can show days as they arrive.
+    """
+    trip_args = (destination, country, start_date, end_date, hotel_name, purpose_of_stay, mode_of_transport, custom_preferences)
+    parts = [('day', iter_travel_itinerary)] + ([('night', iter_night_itinerary)] if nightlife else [])
+    received = {part: [] for part, _ in parts}
+    result = {'day': None, 'night': None}
 
-        all_itineraries.append(itinerary)
-    return all_itineraries
+    with metrics.run_metrics(f"{destination}, {country}") as run:
+        for part, iterate in parts:
+            with metrics.span(f"{part}_itineraries"):
+                # Generation checks job.stopped() between calls, so a cancel noticed by the heartbeat ends it early
+                days = iterate(*trip_args, stopped=job.stopped)
+                try:
+                    for verified_day in days:
+                        received[part].append(verified_day)
+                        job.report(received)
+                finally:
+                    # Stops the pending Gemini calls when the job is cancelled
+                    days.close()
+                job.check()
+            result[part] = collect_itineraries(received[part])
+    result['metrics'] = run.to_json()
+    return result
@@ -0,0 +1,185 @@
+import sqlite3
+import json
+import os
+import threading
+import time
+import config
+
+# SQLite file in config.CACHE_DIR holding the on-disk caches, shared by every process pointed at it
+CACHE_FILE = 'triptailor.sqlite3'
+
+# Last-access times are only rewritten when older than this, to keep reads mostly read-only
+ACCESS_RESOLUTION = 60
+# Writes between two full evictions. In between, a running total of the bytes written decides
+# whether the size bound is exceeded, writes from other processes are only counted at the next one
+EVICT_EVERY = 100
+# Share of max_bytes left once the bound has been exceeded, so the next writes do not evict again straight away
+EVICT_TARGET = 0.9
+
+# Every cache created in this process, by name
+caches = {}
+
+def cache_path():
+    return os.path.join(config.CACHE_DIR, CACHE_FILE)
+
+class DiskCache:
+    """
+    Persistent key/value cache stored in a SQLite table.
+
+    Values are stored as JSON. Entries older than `ttl` seconds are treated as missing, and once
+    the stored values exceed `max_bytes` the least recently used entries are evicted. SQLite in
+    WAL mode with a busy timeout makes the cache safe to share between threads and processes.
+    Eviction runs when the running size total passes `max_bytes` or every EVICT_EVERY writes,
+    not on every write.
+    """
+
+    def __init__(self, name, ttl=None, max_bytes=None, path=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path or cache_path()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Stored bytes as of the last eviction plus everything written since, None until counted
+        self._size = None
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        caches[name] = self
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS "{self.name}" (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.name}_accessed" ON "{self.name}" (accessed)')
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads, so every thread opens its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key, default=None):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(f'SELECT value, created, accessed FROM "{self.name}" WHERE key = ?', (key,)).fetchone()
+
+        if row is None:
+            self._count('misses')
+            return default
+
+        value, created, accessed = row
+        if self.ttl is not None and created + self.ttl < now:
+            with conn:
+                conn.execute(f'DELETE FROM "{self.name}" WHERE key = ? AND created = ?', (key, created))
+            self._count('misses')
+            return default
+
+        if accessed + ACCESS_RESOLUTION < now:
+            with conn:
+                conn.execute(f'UPDATE "{self.name}" SET accessed = ? WHERE key = ?', (now, key))
+        self._count('hits')
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        data = json.dumps(value)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f'INSERT OR REPLACE INTO "{self.name}" (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, data, len(data), now, now)
+            )
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            self._writes += 1
+            if self._size is not None:
+                # Replaced values are counted twice until the next eviction recounts
+                self._size += len(data)
+            due = self._size is None or self._size > self.max_bytes or self._writes >= EVICT_EVERY
+            if due:
+                self._writes = 0
+        if due:
+            self.evict()
+
+    def keys_to_refresh(self, within):
+        # Keys read since they were last written that expire in the next `within` seconds, soonest first
+        if self.ttl is None:
+            return []
+        rows = self._connection().execute(
+            f'SELECT key FROM "{self.name}" WHERE accessed > created AND created < ? ORDER BY created',
+            (time.time() + within - self.ttl,)
+        )
+        return [key for key, in rows]
+
+    def delete(self, key):
+        conn = self._connection()
+        with conn:
+            conn.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (key,))
+
+    def evict(self):
+        # Drop expired entries first, then least recently used ones until the size is back under EVICT_TARGET
+        conn = self._connection()
+        with conn:
+            if self.ttl is not None:
+                expired = conn.execute(f'DELETE FROM "{self.name}" WHERE created < ?', (time.time() - self.ttl,)).rowcount
+                self._count('evictions', expired)
+
+            total = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM "{self.name}"').fetchone()[0]
+            if self.max_bytes is None or total <= self.max_bytes:
+                self._size = total
+                return
+
+            evicted = []
+            for key, size in conn.execute(f'SELECT key, size FROM "{self.name}" ORDER BY accessed'):
+                if total <= self.max_bytes * EVICT_TARGET:
+                    break
+                evicted.append((key,))
+                total -= size
+            conn.executemany(f'DELETE FROM "{self.name}" WHERE key = ?', evicted)
+            self._count('evictions', len(evicted))
+            self._size = total
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute(f'DELETE FROM "{self.name}"')
+        self._size = None
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        entries, size = self._connection().execute(f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "{self.name}"').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size
+        }
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
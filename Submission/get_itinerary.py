@@ -1,19 +1,161 @@
 import streamlit as st
 import json
-import google.generativeai as genai
-from datetime import datetime
+import re
 import traceback
+from datetime import datetime
+import config
+import metrics
+from disk_cache import DiskCache
+from place_index import normalize_query
+from rate_limit import gemini_limiter
+from singleflight import SingleFlight
 
 
-GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
-genai.configure(api_key=GOOGLE_API_KEY)
-google_places_api_key = st.secrets['MAPS_API_KEY']
-weather_api_key = st.secrets['WEATHER']
+@st.cache_resource(show_spinner=False)
+def itinerary_cache():
+    # Day itineraries from Gemini, shared by every session, restart and replica using the same CACHE_DIR.
+    # Keyed on the normalized trip inputs (see itinerary_cache_key), not on the exact request
+    return DiskCache('itineraries', ttl=config.ITINERARY_CACHE_TTL, max_bytes=config.ITINERARY_CACHE_MAX_BYTES)
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def get_daily_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, used_places, mode_of_transport, custom_preferences):
-    used_places_str = ", ".join(used_places)
-    user_message = f"""
+# Sessions missing the cache for the same itinerary at the same time share one Gemini call
+itinerary_flight = SingleFlight('itineraries')
+# Stands for the hotel of the trip in cached itineraries, so they can be reused from any hotel
+HOTEL_PLACEHOLDER = '{hotel}'
+# Kind of weather by words of the weatherapi.com condition, the first match wins
+WEATHER_CONDITIONS = (
+    ('storm', ('thunder', 'storm')),
+    ('snow', ('snow', 'sleet', 'blizzard', 'ice pellets')),
+    ('rain', ('rain', 'drizzle', 'shower')),
+    ('fog', ('fog', 'mist')),
+    ('cloudy', ('cloud', 'overcast')),
+    ('clear', ('sunny', 'clear'))
+)
+
+def generate(model, prompt, **kwargs):
+    """
+    model.generate_content behind the process-wide Gemini limiter. A quota error (429) pauses the
+    limiter for every caller and the call is retried, so a busy moment delays the itinerary
+    instead of dropping days from it.
+    """
+    # Loaded with google.generativeai, which the model comes from
+    from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+    for attempt in range(config.GEMINI_QUOTA_RETRIES + 1):
+        gemini_limiter().acquire()
+        try:
+            return model.generate_content(prompt, **kwargs)
+        except (ResourceExhausted, TooManyRequests):
+            if attempt == config.GEMINI_QUOTA_RETRIES:
+                raise
+            delay = min(config.GEMINI_QUOTA_BACKOFF_MAX, config.GEMINI_QUOTA_BACKOFF * 2 ** attempt)
+            print(f"Gemini quota exceeded, retrying in {delay}s")
+            gemini_limiter().pause(delay)
+
+def weather_class(weather_forecast):
+    # "Patchy rain nearby: 14.2°C (max), 8.1°C (min)" is "rain mild", the itinerary only depends on the kind of weather
+    match = re.match(r'(.*): (-?[\d.]+)°C \(max\)', weather_forecast or '')
+    if match is None:
+        return 'unknown'
+    condition = match.group(1).casefold()
+    kind = next((name for name, words in WEATHER_CONDITIONS if any(word in condition for word in words)), 'other')
+    max_temp = float(match.group(2))
+    return f"{kind} {'cold' if max_temp < 10 else 'hot' if max_temp >= 25 else 'mild'}"
+
+def normalize_preferences(custom_preferences):
+    # The same words in any order, case or punctuation are the same preferences
+    return ' '.join(sorted(set(normalize_query(custom_preferences or '').split())))
+
+def itinerary_cache_key(kind, destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    """
+    Requests getting the same kind of day share a key: destination, weekday, version, purpose,
+    transport (not for nightlife), preferences and kind of weather. The date, hotel, trip length and
+    the places of earlier days are left out, the caller still drops places the trip already used.
+    """
+    weekday = datetime.strptime(date, '%Y-%m-%d').strftime('%a')
+    # A trip longer than a week has the same weekday twice, each gets its own day
+    week = (day_number - 1) // 7
+    return "|".join([
+        kind, normalize_query(destination), normalize_query(country), weekday, str(week), str(itinerary_version),
+        normalize_query(purpose_of_stay), mode_of_transport if kind == 'day' else '',
+        normalize_preferences(custom_preferences), weather_class(weather_forecast)
+    ])
+
+def is_complete_itinerary(itinerary):
+    return isinstance(itinerary, dict) and bool(itinerary) and all(
+        isinstance(item, dict) and all(field in item for field in ITINERARY_ENTRY_FIELDS) for item in itinerary.values())
+
+def to_cached(itinerary, hotel_name, date):
+    # The hotel of the trip becomes the placeholder, the date is kept to move time_int to other dates
+    hotel = normalize_query(hotel_name or '')
+    entries = {}
+    for key, item in itinerary.items():
+        item = dict(item)
+        if hotel and normalize_query(str(item['place'])) == hotel:
+            item['place'] = HOTEL_PLACEHOLDER
+        if hotel_name:
+            item['activity'] = re.sub(re.escape(hotel_name), HOTEL_PLACEHOLDER, item['activity'], flags=re.IGNORECASE)
+        entries[key] = item
+    return {'date': date, 'itinerary': entries}
+
+def from_cached(entry, hotel_name, date):
+    # A cached day as it would have been generated for this trip: its hotel, and time_int on its date
+    shift = (datetime.strptime(date, '%Y-%m-%d') - datetime.strptime(entry['date'], '%Y-%m-%d')).days * 86400
+    hotel = hotel_name or 'Hotel'
+    itinerary = {}
+    for key, item in entry['itinerary'].items():
+        item = dict(item, place=item['place'].replace(HOTEL_PLACEHOLDER, hotel), activity=item['activity'].replace(HOTEL_PLACEHOLDER, hotel))
+        try:
+            item['time_int'] = str(int(item['time_int']) + shift)
+        except (TypeError, ValueError):
+            pass
+        itinerary[key] = item
+    return itinerary
+
+def cached_itinerary(kind, prompt, *args):
+    """
+    The day itinerary for args (as passed to get_daily_itinerary) from the itinerary cache, or
+    from Gemini when no similar request was answered within ITINERARY_CACHE_TTL. None if Gemini
+    did not return a usable itinerary.
+    """
+    date, hotel_name = args[2], args[3]
+    key = itinerary_cache_key(kind, *args)
+    entry = itinerary_cache().get(key)
+    if entry is not None:
+        metrics.annotate(cache='disk')
+    else:
+        entry, shared = itinerary_flight.do(key, generate_cached_itinerary, key, prompt, hotel_name, date)
+        if shared:
+            metrics.annotate(cache='coalesced')
+    return None if entry is None else from_cached(entry, hotel_name, date)
+
+def generate_cached_itinerary(key, prompt, hotel_name, date):
+    model = config.gemini().GenerativeModel('gemini-1.5-flash')
+    itinerary = parse_itinerary_response(generate(model, prompt))
+    if not is_complete_itinerary(itinerary):
+        return None
+    entry = to_cached(itinerary, hotel_name, date)
+    itinerary_cache().set(key, entry)
+    return entry
+
+def stream_cached_itinerary(kind, prompt, *args):
+    # A cached day is yielded at once, a streamed one is stored once Gemini has finished it
+    date, hotel_name = args[2], args[3]
+    key = itinerary_cache_key(kind, *args)
+    entry = itinerary_cache().get(key)
+    if entry is not None:
+        with metrics.span('gemini') as span:
+            span.cache = 'disk'
+        yield from from_cached(entry, hotel_name, date).items()
+        return
+
+    itinerary = {}
+    if (yield from stream_itinerary_entries(prompt, itinerary)) and is_complete_itinerary(itinerary):
+        itinerary_cache().set(key, to_cached(itinerary, hotel_name, date))
+
+def used_places_text(used_places):
+    return ", ".join(used_places) or "none"
+
+def daily_itinerary_prompt(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    return f"""
     Create a detailed itinerary for day {day_number} of a {trip_length}-day trip to {destination}, {country}.
     Date: {date}
     Staying at: {hotel_name}
@@ -29,7 +171,8 @@ def get_daily_itinerary(destination, country, date, hotel_name, purpose_of_stay,
     1. Do not include breakfast or any activities at the hotel.
     2. Start the itinerary with the first activity outside the hotel.
     3. Do not repeat any place names within the same itinerary. Each day should have unique activities.
-    4. The following places have already been used in previous days and should not be suggested again: {used_places_str}
+    4. The following places have already been used in previous days and should not be suggested again: {used_places_text(used_places)}
+       This is version {itinerary_version} of 3 alternative itineraries for this trip. Make it distinct from the other versions by favouring different neighbourhoods, sights and restaurants.
     5. Ensure all suggested places are within {destination}. Do not suggest places in other cities or more than 2 hours away from the city.
     6. Consider the mode of transportation when suggesting places. If the mode is walking, keep destinations closer together.
     7. Take into account the custom preferences provided by the user.
@@ -54,26 +197,20 @@ def get_daily_itinerary(destination, country, date, hotel_name, purpose_of_stay,
         ...
     }}
     """
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(user_message)
 
-    try:
-        response_text = response.text
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        json_str = response_text[json_start:json_end]
-        return json.loads(json_str)
-    except Exception as e:
-        print(f"Error processing Gemini response: {e}")
-        print(f"Response: {response}")
-        print(f"Exception type: {type(e)}")
-        print(f"Exception traceback: {traceback.format_exc()}")
-        return None
-        
+@metrics.timed('gemini', cached=True)
 @st.cache_data(ttl=3600,show_spinner=False)
-def get_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, used_places, mode_of_transport, custom_preferences):
-    # used_places_str = ", ".join(used_places)
-    user_message = f"""
+def get_daily_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    args = (destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences)
+    return cached_itinerary('day', daily_itinerary_prompt(*args), *args)
+
+def stream_daily_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    # Yields (key, entry) for each activity while Gemini is still generating the rest
+    args = (destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences)
+    return stream_cached_itinerary('day', daily_itinerary_prompt(*args), *args)
+
+def nightlife_itinerary_prompt(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    return f"""
     Create a daily nightlife itinerary starting for day {day_number} of a {trip_length}-day trip to {destination}, {country}.
     It should start from 22:00 on {date} and end at 04:00 the next day
     Date: {date}
@@ -89,6 +226,8 @@ def get_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_s
     1. Do not repeat any place names within the same itinerary. Each day should have unique places.
     2. Include atleast 1 local pub or bar
     3. Check if events exist at Resident Advisor Guide in the city.
+    4. The following places have already been used in previous nights and should not be suggested again: {used_places_text(used_places)}
+       This is version {itinerary_version} of 3 alternative nightlife itineraries for this trip. Make it distinct from the other versions by favouring different venues and areas.
     5. Ensure all suggested places are within {destination}. Do not suggest places in other cities or more than 2 hours away from the city.
     6. Ignore the mode of transportation when suggesting places.
     7. Take into account the custom preferences provided by the user.
@@ -110,12 +249,167 @@ def get_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_s
     }}
     """
 
+@metrics.timed('gemini', cached=True)
+@st.cache_data(ttl=3600,show_spinner=False)
+def get_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    args = (destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences)
+    return cached_itinerary('night', nightlife_itinerary_prompt(*args), *args)
+
+def stream_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences):
+    args = (destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, trip_length, itinerary_version, used_places, mode_of_transport, custom_preferences)
+    return stream_cached_itinerary('night', nightlife_itinerary_prompt(*args), *args)
+
+def trip_days_text(dates, weather_forecasts):
+    return "\n".join(f"    - Day {day_number} ({date}): {weather_forecast}" for day_number, (date, weather_forecast) in enumerate(zip(dates, weather_forecasts), 1))
+
+def multi_day_itinerary_prompt(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences):
+    return f"""
+    Create a detailed itinerary for every day of a {len(dates)}-day trip to {destination}, {country}.
+    Staying at: {hotel_name}
+    Purpose of stay: {purpose_of_stay}
+    Mode of transportation: {mode_of_transport}
+    Custom preferences: {custom_preferences}
+    Days and weather forecast:
+{trip_days_text(dates, weather_forecasts)}
+
+    Please provide a full days itinerary for each of these dates with suggested times for each activity. Include local meals, sightseeing, and other relevant activities.
+    Be specific with place names and try to suggest a variety of activities suitable for the destination, weather, and transportation mode.
+
+    Important guidelines:
+    1. Do not include breakfast or any activities at the hotel.
+    2. Start each day with the first activity outside the hotel.
+    3. Every place name may appear only once in the whole response. Do not repeat a place on the same day or on any other day.
+    4. This is version {itinerary_version} of 3 alternative itineraries for this trip. Make it distinct from the other versions by favouring different neighbourhoods, sights and restaurants.
+    5. Ensure all suggested places are within {destination}. Do not suggest places in other cities or more than 2 hours away from the city.
+    6. Consider the mode of transportation when suggesting places. If the mode is walking, keep destinations closer together.
+    7. Take into account the custom preferences provided by the user.
+    8. End each day with going back to the place the person is staying at.
+    9. The person will always be staying at the hotel that is within the same city of destination. If you cannot find a hotel by that name in the same city, assume that the person is staying somewhere within the city centre main station.
+    10. Aim for a diverse range of activities across the entire trip. If a specific activity or cuisine is requested in custom preferences, include it once or twice during the trip, not every day.
+    11. If a specific food or cuisine is mentioned in the custom preferences, suggest it for one meal, but vary other meal suggestions, do not suggest the same meal for multiple days in a row.
+    12. Group activities by area each day to minimize travel time.
+
+    Format the output as a JSON object keyed by date (YYYY-MM-DD), where each date holds that day's entries, each entry containing:
+    - time: suggested time for the activity on that date in the local timezone of the place (for example 09:00)
+    - activity: short description of the activity
+    - place: specific name of the place to visit
+    - time_int: suggested time for the activity on that date in the local timezone of the place (for example 09:00) but as an integer in seconds since midnight, January 1, 1970 UTC
+    - approx_distance : approximate distance in kms from the main train station
+
+    Example format:
+    {{
+        "{dates[0]}": {{
+            "1": {{"time": "09:30", "activity": "Morning walk", "place": "Specific Park Name","time_int":"1722562818","approx_distance":"2.6 kms"}},
+            "2": {{"time": "11:00", "activity": "Visit museum", "place": "Specific Museum Name","time_int":"1722572818","approx_distance":"2.6 kms"}},
+            ...
+        }},
+        ...
+    }}
+    """
+
+def multi_night_itinerary_prompt(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences):
+    return f"""
+    Create a nightlife itinerary for every night of a {len(dates)}-day trip to {destination}, {country}.
+    Each night should start from 22:00 on its date and end at 04:00 the next day
+    Staying at: {hotel_name}
+    Purpose of stay: {purpose_of_stay}
+    Mode of transportation: {mode_of_transport}
+    Custom preferences: {custom_preferences}
+    Nights and weather forecast:
+{trip_days_text(dates, weather_forecasts)}
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(user_message)
+    Please provide the nightlife itinerary for each of these dates with suggested times for each place. Be specific with place names and try to suggest special events if any.
 
+    Important guidelines:
+    1. Every place name may appear only once in the whole response. Do not repeat a place on the same night or on any other night.
+    2. Include atleast 1 local pub or bar each night
+    3. Check if events exist at Resident Advisor Guide in the city.
+    4. This is version {itinerary_version} of 3 alternative nightlife itineraries for this trip. Make it distinct from the other versions by favouring different venues and areas.
+    5. Ensure all suggested places are within {destination}. Do not suggest places in other cities or more than 2 hours away from the city.
+    6. Ignore the mode of transportation when suggesting places.
+    7. Take into account the custom preferences provided by the user.
+    8. End each night with going back to the place the person is staying at around 03:30 in the morning next day.
+    9. The person will always be staying at the hotel that is within the same city of destination. If you cannot find a hotel by that name in the same city, assume that the person is staying somewhere within the city centre main station.
+
+    Format the output as a JSON object keyed by date (YYYY-MM-DD), where each date holds that night's entries, each entry containing:
+    - time: suggested time for the activity on that date in the local timezone of the place (for example 22:00)
+    - activity: short description of the activity
+    - place: specific name of the place to visit
+    - time_int: suggested time for the activity on that date in the local timezone of the place (for example 22:00) but as an integer in seconds since midnight, January 1, 1970 UTC
+    - approx_distance : approximate distance in kms from the main train station
+
+    Example format:
+    {{
+        "{dates[0]}": {{
+            "1": {{"time": "22:00", "activity": "Drinks", "place": "Specific Bar Name","time_int":"1722562818","approx_distance":"2.6 kms"}},
+            "2": {{"time": "23:30", "activity": "Live music", "place": "Specific Club Name","time_int":"1722572818","approx_distance":"2.6 kms"}},
+            ...
+        }},
+        ...
+    }}
+    """
+
+ITINERARY_ENTRY_FIELDS = ('time', 'activity', 'place', 'time_int', 'approx_distance')
+
+def split_multi_day_itinerary(response_json, dates):
+    """
+    Split a multi-day response into {date: daily itinerary}. Entries reusing a place from earlier
+    in the response are dropped, and a day that is missing, malformed or left empty maps to None
+    so it can be regenerated on its own.
+    """
+    days = {}
+    seen_places = set()
+    for date in dates:
+        daily_itinerary = response_json.get(date) if isinstance(response_json, dict) else None
+        if not isinstance(daily_itinerary, dict) or not all(isinstance(item, dict) and all(field in item for field in ITINERARY_ENTRY_FIELDS) for item in daily_itinerary.values()):
+            days[date] = None
+            continue
+
+        unique_itinerary = {}
+        for key, item in daily_itinerary.items():
+            if item['place'] in seen_places:
+                continue
+            seen_places.add(item['place'])
+            unique_itinerary[key] = item
+        days[date] = unique_itinerary or None
+    return days
+
+@metrics.timed('gemini', cached=True)
+@st.cache_data(ttl=3600,show_spinner=False)
+def get_multi_day_itinerary(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences):
+    # One Gemini call for a whole version, returns {date: daily itinerary or None}
+    prompt = multi_day_itinerary_prompt(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences)
+    return cached_multi_day_itinerary('day', prompt, destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences)
+
+@metrics.timed('gemini', cached=True)
+@st.cache_data(ttl=3600,show_spinner=False)
+def get_multi_night_itinerary(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences):
+    prompt = multi_night_itinerary_prompt(destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences)
+    return cached_multi_day_itinerary('night', prompt, destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences)
+
+def cached_multi_day_itinerary(kind, prompt, destination, country, dates, hotel_name, purpose_of_stay, weather_forecasts, itinerary_version, mode_of_transport, custom_preferences):
+    """
+    A whole version from the itinerary cache when every one of its days is there, otherwise from one
+    Gemini call whose days are stored for later requests, single-day ones included.
+    """
+    keys = [itinerary_cache_key(kind, destination, country, date, hotel_name, purpose_of_stay, weather_forecast, day_number, len(dates), itinerary_version, (), mode_of_transport, custom_preferences)
+            for day_number, (date, weather_forecast) in enumerate(zip(dates, weather_forecasts), 1)]
+    entries = [itinerary_cache().get(key) for key in keys]
+    if all(entry is not None for entry in entries):
+        metrics.annotate(cache='disk')
+        return {date: from_cached(entry, hotel_name, date) for date, entry in zip(dates, entries)}
+
+    model = config.gemini().GenerativeModel('gemini-1.5-flash')
+    days = split_multi_day_itinerary(parse_itinerary_response(generate(model, prompt)), dates)
+    for key, date in zip(keys, dates):
+        if is_complete_itinerary(days[date]):
+            itinerary_cache().set(key, to_cached(days[date], hotel_name, date))
+    return days
+
+def parse_itinerary_response(response):
     try:
         response_text = response.text
+        metrics.annotate(cache='miss', payload_bytes=len(response_text.encode()))
         json_start = response_text.find('{')
         json_end = response_text.rfind('}') + 1
         json_str = response_text[json_start:json_end]
@@ -127,29 +421,69 @@ def get_nightlife_itinerary(destination, country, date, hotel_name, purpose_of_s
         print(f"Exception traceback: {traceback.format_exc()}")
         return None
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def is_place_in_location(place, destination, country):
-    address = place['formatted_address'].lower()
-    return (destination.lower() in address or country.lower() in address or
-            any(destination.lower() in component['long_name'].lower() or
-                country.lower() in component['long_name'].lower()
-                for component in place.get('address_components', [])))
+def iter_json_entries(chunks):
+    """
+    Incrementally parse a streamed JSON object of the form {"1": {...}, "2": {...}}, yielding
+    (key, entry) for every member object as soon as its closing brace has arrived.
+    """
+    buffer = ""
+    position = 0
+    depth = 0
+    in_string = escaped = False
+    member_start = entry_start = None
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def get_place_opening_hours(place, date):
-    if 'opening_hours' not in place or 'periods' not in place['opening_hours']:
-        return "Opening hours not available" 
-
-    dt = datetime.strptime(date, "%Y-%m-%d")
-    day_of_week = dt.weekday()
-
-    for period in place['opening_hours']['periods']:
-        if period['open']['day'] == day_of_week:
-            open_time = datetime.strptime(period['open']['time'], "%H%M").strftime("%I:%M %p")
-            if 'close' not in period:
-                # Place might be open 24/7
-                return f"{open_time} - Open 24 hours"
-            close_time = datetime.strptime(period['close']['time'], "%H%M").strftime("%I:%M %p")
-            return f"{open_time} - {close_time}"
-
-    return "Closed"
\ No newline at end of file
+    for chunk in chunks:
+        buffer += chunk
+        while position < len(buffer):
+            char = buffer[position]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"' and depth > 0:
+                # Quotes are only tracked inside the object, the text around it may be prose
+                in_string = True
+            elif char == '{':
+                depth += 1
+                if depth == 1:
+                    member_start = position + 1
+                elif depth == 2:
+                    entry_start = position
+            elif char == '}' and depth > 0:
+                if depth == 2:
+                    key = re.search(r'"((?:[^"\\]|\\.)*)"\s*:\s*$', buffer[member_start:entry_start])
+                    try:
+                        yield (key.group(1) if key else str(entry_start), json.loads(buffer[entry_start:position + 1]))
+                    except json.JSONDecodeError as e:
+                        print(f"Error decoding streamed itinerary entry: {e}")
+                    member_start = position + 1
+                depth -= 1
+            position += 1
+
+def chunk_texts(response, span):
+    # Text of every streamed chunk, counting the received bytes on the span
+    for chunk in response:
+        span.payload_bytes += len(chunk.text.encode())
+        yield chunk.text
+
+def stream_itinerary_entries(user_message, received=None):
+    # Yields (key, entry) as they stream in, also kept in received. Returns whether the response was read to the end
+    model = config.gemini().GenerativeModel('gemini-1.5-flash')
+    received = {} if received is None else received
+    with metrics.span('gemini') as span:
+        span.cache = 'miss'
+        try:
+            response = generate(model, user_message, stream=True)
+            for key, entry in iter_json_entries(chunk_texts(response, span)):
+                received[key] = entry
+                yield key, entry
+        except Exception as e:
+            span.error = type(e).__name__
+            print(f"Error streaming Gemini response: {e}")
+            print(f"Exception type: {type(e)}")
+            print(f"Exception traceback: {traceback.format_exc()}")
+            return False
+    return True
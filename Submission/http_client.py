@@ -0,0 +1,85 @@
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+import random
+import threading
+import time
+import config
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Only these are retried after a 5xx or a connection error, a POST may already have been acted upon
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+@st.cache_resource(show_spinner=False)
+def session():
+    # Shared by every request of the process, created on first use with HTTP_POOL_SIZE keep-alive connections per host
+    shared = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=config.HTTP_POOL_SIZE)
+    shared.mount('https://', adapter)
+    shared.mount('http://', adapter)
+    return shared
+
+_lock = threading.Lock()
+counters = {'requests': 0, 'retries': 0, 'timeouts': 0, 'connection_errors': 0}
+
+def _count(counter):
+    with _lock:
+        counters[counter] += 1
+
+def backoff_delay(attempt, response=None):
+    # Honour Retry-After when the server sends one, otherwise sleep a random time up to the exponential cap
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), config.HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(config.HTTP_BACKOFF_MAX, config.HTTP_BACKOFF * 2 ** attempt))
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Send a request through the shared session. 429 responses are retried for every method;
+    5xx responses, timeouts and connection errors only for idempotent ones. The last response
+    is returned once retries run out, and the last exception is raised if there was no response.
+    """
+    method = method.upper()
+    retries = config.HTTP_RETRIES if retries is None else retries
+    timeout = timeout or (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+
+    for attempt in range(retries + 1):
+        _count('requests')
+        try:
+            response = session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            _count('timeouts' if isinstance(e, requests.Timeout) else 'connection_errors')
+            if attempt == retries or method not in IDEMPOTENT_METHODS:
+                raise
+            response = None
+        else:
+            retryable = response.status_code == 429 or (response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS)
+            if attempt == retries or not retryable:
+                return response
+        _count('retries')
+        time.sleep(backoff_delay(attempt, response))
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
+
+def pool_stats():
+    # Connections opened and requests sent per host; every request beyond the connections reused one
+    hosts = {}
+    adapter = session().get_adapter('https://')
+    for key in list(adapter.poolmanager.pools.keys()):
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is None:
+            continue
+        host = f"{pool.scheme}://{pool.host}:{pool.port}"
+        hosts[host] = {
+            'connections': pool.num_connections,
+            'requests': pool.num_requests,
+            'reused': max(0, pool.num_requests - pool.num_connections),
+            # The pool queue is padded with None up to its size, only real connections are idle ones
+            'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+        }
+    with _lock:
+        return {**counters, 'hosts': hosts}
@@ -0,0 +1,117 @@
+import sys
+import threading
+import weakref
+from collections.abc import Mapping
+
+class Record(Mapping):
+    """
+    Read-only record with one slot per field, read like the dict it replaces: record['name'],
+    record.get('url'), 'open_at_visit' in record. Fields missing from the dict stay unset and
+    raise KeyError as before. Keys outside FIELDS are kept in a small `extra` dict.
+    """
+    __slots__ = ('extra',)
+    FIELDS = ()
+
+    def __init__(self, data):
+        extra = None
+        for key, value in data.items():
+            if key in self.FIELDS:
+                object.__setattr__(self, key, value)
+            else:
+                extra = extra or {}
+                extra[key] = value
+        object.__setattr__(self, 'extra', extra)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __reduce__(self):
+        # Pickled (e.g. by st.cache_data) as the plain dict, so places are interned again on load
+        return (self.from_dict, (dict(self),))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data)
+
+def intern_strings(data, keys):
+    # Short texts repeated across days, versions and sessions (dates, times, weather, hours) share one object
+    return {key: sys.intern(value) if key in keys and type(value) is str else value for key, value in data.items()}
+
+class Place(Record):
+    """
+    Place details, interned: every activity at the same venue, in any version, set or session
+    of this process, refers to one Place. It is dropped once no itinerary refers to it.
+    """
+    FIELDS = ('name', 'formatted_address', 'type', 'opening_hours', 'rating', 'user_ratings_total', 'url', 'location', 'weekly_hours')
+    __slots__ = FIELDS + ('__weakref__',)
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, Place):
+            return data
+        key = (data.get('name'), data.get('formatted_address'), data.get('rating'), data.get('user_ratings_total'), data.get('url'))
+        with _places_lock:
+            place = _places.get(key)
+            if place is None:
+                place = _places[key] = cls(intern_strings(data, ('type',)))
+            return place
+
+_places = weakref.WeakValueDictionary()
+_places_lock = threading.Lock()
+
+class Activity(Record):
+    FIELDS = ('time', 'activity', 'place', 'opening_hours', 'time_int', 'approx_distance', 'open_at_visit', 'duration_to_next', 'duration_to_next_value')
+    __slots__ = FIELDS
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, Activity):
+            return data
+        data = intern_strings(data, ('time', 'opening_hours', 'duration_to_next'))
+        data['place'] = Place.from_dict(data['place'])
+        return cls(data)
+
+class Day(Record):
+    FIELDS = ('date', 'weather', 'activities')
+    __slots__ = FIELDS
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, Day):
+            return data
+        data = intern_strings(data, ('date', 'weather'))
+        data['activities'] = tuple(Activity.from_dict(activity) for activity in data['activities'])
+        return cls(data)
+
+def compact_versions(versions):
+    """Itinerary versions (lists of day dicts) as tuples of Day records, None stays None."""
+    if versions is None:
+        return None
+    return tuple(tuple(Day.from_dict(day) for day in version) for version in versions)
+
+def interned_places():
+    # Places currently shared by the itineraries held in this process
+    return len(_places)
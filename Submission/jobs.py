@@ -0,0 +1,390 @@
+import streamlit as st
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+import config
+from disk_cache import cache_path
+
+# Heartbeats a worker sends per JOB_HEARTBEAT_TIMEOUT while the handler runs, progress or not
+HEARTBEATS_PER_TIMEOUT = 5
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Function run for each kind of job, registered with @handler
+handlers = {}
+# Setting holding the seconds between two runs of each periodic job, registered with @periodic
+schedules = {}
+
+class JobCancelled(Exception):
+    pass
+
+class JobLost(Exception):
+    """The job was queued again and claimed by another worker, this run must stop without finishing it."""
+
+class RetryLater(Exception):
+    """Raised by a handler to queue its job again, to be claimed after `delay` seconds."""
+    def __init__(self, delay, reason=''):
+        super().__init__(reason)
+        self.delay = delay
+
+def handler(kind):
+    """Register func(job, *args) as the handler of `kind` jobs, its return value is the job result."""
+    def decorator(func):
+        handlers[kind] = func
+        return func
+    return decorator
+
+def periodic(kind, interval_setting):
+    """
+    Register func(job, period) as a job run by an idle worker every config.<interval_setting> seconds,
+    never if that is 0. `period` is the number of the interval, so the job key lets only one process
+    submit it per interval.
+    """
+    def decorator(func):
+        handlers[kind] = func
+        schedules[kind] = interval_setting
+        return func
+    return decorator
+
+def job_key(kind, args):
+    return hashlib.sha256(json.dumps([kind, args], sort_keys=True).encode()).hexdigest()
+
+class JobStore:
+    """
+    Jobs in a SQLite table next to the caches, so every web and worker process pointed at
+    CACHE_DIR sees the same queue. Arguments, progress and results are stored as JSON.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or cache_path()
+        self._local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    created REAL NOT NULL,
+                    started REAL,
+                    heartbeat REAL,
+                    finished REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_after REAL
+                )
+            """)
+            # Tables created before jobs could be retried
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            if 'run_after' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN run_after REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)')
+
+    def _connection(self):
+        # Same as DiskCache: one connection per thread, WAL so readers never wait for the workers
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes never claim the same job
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def submit(self, kind, args, reuse_done=True):
+        """
+        Queue a job and return its ID, or the ID of an identical job queued, running or (with
+        reuse_done) done in the last JOB_TTL seconds. Jobs asked to cancel are never reused.
+        """
+        now = time.time()
+        key = job_key(kind, args)
+        conn = self._transaction()
+        try:
+            row = conn.execute(
+                'SELECT id FROM jobs WHERE key = ? AND cancel_requested = 0 AND (status IN (?, ?) OR (status = ? AND finished > ?)) ORDER BY created DESC LIMIT 1',
+                (key, QUEUED, RUNNING, DONE, now - config.JOB_TTL if reuse_done else now)
+            ).fetchone()
+            if row is not None:
+                job_id = row['id']
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute('INSERT INTO jobs (id, kind, key, args, status, created) VALUES (?, ?, ?, ?, ?, ?)',
+                             (job_id, kind, key, json.dumps(args), QUEUED, now))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return job_id
+
+    def claim(self, worker):
+        # Oldest queued job that is due, marked as running for this worker. Jobs of workers that stopped reporting are queued again first
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.execute('UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?',
+                         (QUEUED, RUNNING, now - config.JOB_HEARTBEAT_TIMEOUT))
+            row = conn.execute('SELECT id, kind, args, attempts FROM jobs WHERE status = ? AND (run_after IS NULL OR run_after <= ?) ORDER BY created LIMIT 1',
+                               (QUEUED, now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET status = ?, worker = ?, started = ?, heartbeat = ? WHERE id = ?',
+                             (RUNNING, worker, now, now, row['id']))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return None if row is None else (row['id'], row['kind'], json.loads(row['args']), row['attempts'])
+
+    def report(self, job_id, worker, progress):
+        """
+        Store the progress of a running job. Returns whether the job still belongs to this worker,
+        and whether cancellation was requested.
+        """
+        conn = self._connection()
+        owned = conn.execute('UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ? AND worker = ? AND status = ?',
+                             (json.dumps(progress), time.time(), job_id, worker, RUNNING)).rowcount > 0
+        return owned, self.cancel_requested(job_id)
+
+    def heartbeat(self, job_id, worker):
+        # Returns False once the job no longer runs on this worker
+        return self._connection().execute('UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = ?',
+                                          (time.time(), job_id, worker, RUNNING)).rowcount > 0
+
+    def cancel_requested(self, job_id):
+        row = self._connection().execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row is None or bool(row['cancel_requested'])
+
+    def finish(self, job_id, worker, status, result=None, error=None):
+        now = time.time()
+        self._connection().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, heartbeat = ? WHERE id = ? AND worker = ?',
+            (status, None if result is None else json.dumps(result), error, now, now, job_id, worker)
+        )
+
+    def retry(self, job_id, worker, delay, error=None):
+        # Back in the queue, not claimed again before the delay is over
+        self._connection().execute(
+            'UPDATE jobs SET status = ?, worker = NULL, attempts = attempts + 1, run_after = ?, error = ? WHERE id = ? AND worker = ?',
+            (QUEUED, time.time() + delay, error, job_id, worker)
+        )
+
+    def cancel(self, job_id):
+        # A queued job is cancelled straight away, a running one once its worker's heartbeat notices the request
+        conn = self._connection()
+        conn.execute('UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?', (CANCELLED, time.time(), job_id, QUEUED))
+        conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?', (job_id, RUNNING))
+
+    def get(self, job_id, with_result=False):
+        columns = 'id, kind, status, progress, error, attempts, created, started, finished' + (', result' if with_result else '')
+        row = self._connection().execute(f'SELECT {columns} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        if with_result:
+            job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def purge(self):
+        # Drop finished jobs past their TTL
+        self._connection().execute('DELETE FROM jobs WHERE status IN (?, ?, ?) AND finished < ?', (*FINISHED, time.time() - config.JOB_TTL))
+
+    def stats(self):
+        counts = dict(self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, *FINISHED)}
+
+class Job:
+    # Handed to the handler to report progress. Handlers call check() between long calls to stop early once cancelled
+    def __init__(self, store, job_id, worker, attempts=0):
+        self.store = store
+        self.id = job_id
+        self.worker = worker
+        # Earlier runs of this job that ended in RetryLater
+        self.attempts = attempts
+        # Set by the heartbeat when another worker took the job over, or when cancellation was requested
+        self.lost = threading.Event()
+        self.cancelled = threading.Event()
+
+    def stopped(self):
+        return self.lost.is_set() or self.cancelled.is_set()
+
+    def check(self):
+        # Raises once the heartbeat noticed the job is lost or cancelled, without a query
+        if self.lost.is_set():
+            raise JobLost(self.id)
+        if self.cancelled.is_set():
+            raise JobCancelled(self.id)
+
+    def report(self, progress):
+        self.check()
+        owned, cancel_requested = self.store.report(self.id, self.worker, progress)
+        if not owned:
+            self.lost.set()
+            raise JobLost(self.id)
+        if cancel_requested:
+            self.cancelled.set()
+            raise JobCancelled(self.id)
+
+class WorkerPool:
+    """Threads running queued jobs from the store, one job at a time each."""
+
+    def __init__(self, store, workers):
+        self.store = store
+        self.workers = workers
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._threads = []
+        # Last interval each periodic job was submitted for by this process
+        self._periods = {}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, args=(f"{self.name}:{i}",), name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def notify(self):
+        # A job was submitted by this process, don't wait for the next poll
+        self._wake.set()
+
+    def run(self, worker):
+        while True:
+            claimed = self.store.claim(worker)
+            if claimed is None:
+                self.schedule()
+                self._wake.wait(config.JOB_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            self.execute(worker, *claimed)
+
+    def schedule(self):
+        # Submit the periodic jobs of the current interval, identical submissions from other processes are merged
+        now = time.time()
+        for kind, interval_setting in schedules.items():
+            interval = config.setting(interval_setting)
+            if interval <= 0:
+                continue
+            period = int(now // interval)
+            if self._periods.get(kind) != period:
+                self._periods[kind] = period
+                self.store.submit(kind, [period])
+
+    def execute(self, worker, job_id, kind, args, attempts=0):
+        func = handlers.get(kind)
+        if func is None:
+            self.store.finish(job_id, worker, FAILED, error=f"No handler for {kind} jobs in this worker")
+            return
+        job = Job(self.store, job_id, worker, attempts)
+        finished = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(job, finished), name=f"job-heartbeat-{job_id[:8]}", daemon=True).start()
+        try:
+            result = func(job, *args)
+        except JobLost:
+            print(f"Stopped {kind} job {job_id}, it was taken over by another worker")
+        except JobCancelled:
+            self.store.finish(job_id, worker, CANCELLED)
+        except RetryLater as e:
+            print(f"Retrying {kind} job {job_id} in {e.delay:g}s: {e}")
+            self.store.retry(job_id, worker, e.delay, error=str(e))
+        except Exception as e:
+            print(f"Error running {kind} job {job_id}: {e}")
+            self.store.finish(job_id, worker, FAILED, error=traceback.format_exc())
+        else:
+            self.store.finish(job_id, worker, DONE, result=result)
+        finally:
+            finished.set()
+
+    def heartbeat(self, job, finished):
+        # Keeps the job claimed while its handler runs, even between two progress reports, and
+        # looks for a cancellation request every JOB_POLL_INTERVAL so the handler can stop early
+        interval = config.JOB_HEARTBEAT_TIMEOUT / HEARTBEATS_PER_TIMEOUT
+        sent = time.monotonic()
+        while not finished.wait(min(config.JOB_POLL_INTERVAL, interval)):
+            if time.monotonic() - sent >= interval:
+                sent = time.monotonic()
+                if not self.store.heartbeat(job.id, job.worker):
+                    job.lost.set()
+                    return
+            if self.store.cancel_requested(job.id):
+                job.cancelled.set()
+                return
+
+@st.cache_resource(show_spinner=False)
+def job_store():
+    # Opened on first use, so importing the module does not touch CACHE_DIR
+    return JobStore()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_workers(workers=None):
+    # Started on first use, so importing the module does not spawn threads. JOB_WORKERS threads by default
+    global _pool
+    workers = config.JOB_WORKERS if workers is None else workers
+    with _pool_lock:
+        if _pool is None and workers > 0:
+            job_store().purge()
+            _pool = WorkerPool(job_store(), workers).start()
+        return _pool
+
+def submit(kind, *args, reuse_done=True):
+    # reuse_done=False for jobs asked for again on purpose (e.g. sending an email twice), only one still pending is shared
+    job_id = job_store().submit(kind, list(args), reuse_done)
+    pool = start_workers()
+    if pool is not None:
+        pool.notify()
+    return job_id
+
+def poll(job_id):
+    # Status and latest progress of a job, None if it is unknown (e.g. purged)
+    return job_store().get(job_id)
+
+def result(job_id):
+    job = job_store().get(job_id, with_result=True)
+    return None if job is None else job['result']
+
+def cancel(job_id):
+    job_store().cancel(job_id)
+
+def job_stats():
+    return job_store().stats()
+
+if __name__ == '__main__':
+    # Dedicated worker process: python jobs.py [workers]
+    import sys
+    import jobs
+    import create_itinerary  # registers the itinerary handlers
+    import mailer  # registers the email handler
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else max(config.JOB_WORKERS, 1)
+    print(f"Running {workers} job worker(s) on {jobs.job_store().path}", flush=True)
+    jobs.start_workers(workers)
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,109 @@
+import smtplib
+import socket
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import make_msgid, parseaddr
+import config
+import jobs
+import metrics
+from pdf_engine import itinerary_rows, submit_pdf
+
+BODY = ("Greetings! \n\nHere is your customised AI generated Itinerary with location, timing and map links for your easy navigation. "
+        "\n\nPrepared by Team KAVA. \nShare TripTailor with your friends :)")
+
+# Function sending an EmailMessage for each transport, registered with @transport
+transports = {}
+
+# Temporary failures, the send is retried. Any other error (refused recipient, bad credentials) fails the email
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)
+
+def transport(name):
+    def decorator(func):
+        transports[name] = func
+        return func
+    return decorator
+
+@transport('smtp')
+def send_smtp(message):
+    if config.SMTP_SECURITY == 'ssl':
+        server = smtplib.SMTP_SSL(config.SMTP_HOST, config.SMTP_PORT, timeout=config.SMTP_TIMEOUT)
+    else:
+        server = smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT, timeout=config.SMTP_TIMEOUT)
+    with server:
+        if config.SMTP_SECURITY == 'starttls':
+            server.starttls()
+        if config.SMTP_USERNAME:
+            server.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
+        server.send_message(message)
+
+def is_transient(error):
+    # 4xx replies are temporary by definition
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, TRANSIENT_ERRORS)
+
+def is_email_address(address):
+    # A single address with something on both sides of the @, the server checks the rest
+    _, parsed = parseaddr(address or '')
+    local, _, domain = parsed.partition('@')
+    return bool(local and domain) and parsed == (address or '').strip()
+
+def format_day(date_string):
+    return datetime.strptime(date_string, "%Y-%m-%d").strftime("%d-%b-%Y")
+
+def itinerary_email(itinerary_set, set_number, email_address, versions):
+    """
+    Arguments of an email job sending the given versions (1-based) of a set, one PDF attachment
+    per version with its day and night itineraries. Only plain text and tuples, so they fit in the job store.
+    """
+    trip_details = itinerary_set['trip_details']
+    dates = f"{format_day(trip_details['start_date'])} to {format_day(trip_details['end_date'])}"
+    location = trip_details['destination'].upper()
+    night_itineraries = itinerary_set.get('night') or []
+    attachments = []
+    for version in versions:
+        if version > len(itinerary_set['day']):
+            continue
+        sections = [(f"Version {version} - Day", itinerary_rows(itinerary_set['day'][version - 1]))]
+        if version <= len(night_itineraries):
+            sections.append((f"Version {version} - Night", itinerary_rows(night_itineraries[version - 1])))
+        attachments.append((f"TripTailor AI - {location} V{version} - {dates}.pdf", f"Itinerary {version} from Set {set_number}", sections))
+    return email_address, f"TripTailor AI : {location} | {dates}", BODY, attachments
+
+def build_message(recipient, subject, body, attachments):
+    # attachments are (filename, bytes) PDFs
+    message = EmailMessage()
+    message['From'] = config.MAIL_FROM
+    message['To'] = recipient
+    message['Subject'] = subject
+    message['Message-ID'] = make_msgid(domain='triptailor')
+    message.set_content(body)
+    for filename, data in attachments:
+        message.add_attachment(data, maintype='application', subtype='pdf', filename=filename)
+    return message
+
+@jobs.handler('email')
+def send_itinerary_email(job, recipient, subject, body, attachments):
+    """
+    Outbox job: render the attachments with the PDF engine and send the email as one message
+    through MAIL_TRANSPORT. Temporary failures put the job back in the queue with a growing delay.
+    """
+    if not recipient:
+        raise ValueError("No email address to send the itineraries to")
+    # Rendered by the PDF process pool, a document exported before comes from its cache
+    futures = [(filename, submit_pdf(title, sections)[0]) for filename, title, sections in attachments]
+    message = build_message(recipient, subject, body, [(filename, future.result()) for filename, future in futures])
+    try:
+        with metrics.span('email'):
+            transports[config.MAIL_TRANSPORT](message)
+    except Exception as e:
+        if not is_transient(e) or job.attempts >= config.OUTBOX_RETRIES:
+            raise
+        raise jobs.RetryLater(min(config.OUTBOX_BACKOFF * 2 ** job.attempts, config.OUTBOX_BACKOFF_MAX), f"{type(e).__name__}: {e}")
+    return {'message_id': message['Message-ID'], 'attachments': len(attachments), 'bytes': len(message.as_bytes())}
+
+def queue_email(itinerary_set, set_number, email_address, versions):
+    # ID of the outbox job. An identical email still waiting to be sent is shared, one already sent is sent again
+    return jobs.submit('email', *itinerary_email(itinerary_set, set_number, email_address, versions), reuse_done=False)
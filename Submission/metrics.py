@@ -0,0 +1,217 @@
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the Prometheus duration histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The run being recorded and the innermost open span, both follow the work into executor threads via submit()
+current_run = contextvars.ContextVar('current_run', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """
+    One timed stage: a Gemini call, a Places lookup, a Distance Matrix request, a PDF build...
+
+    `cache` is "hit" (served from st.cache_data), "disk" (served from a DiskCache), "miss" (went to
+    the API) or None when the stage has no cache.
+    """
+    __slots__ = ('stage', 'start', 'duration', 'payload_bytes', 'cache', 'error')
+
+    def __init__(self, stage, cache=None):
+        self.stage = stage
+        self.start = time.time()
+        self.duration = 0.0
+        self.payload_bytes = 0
+        self.cache = cache
+        self.error = None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class StageStats:
+    # Running totals of every span recorded for one stage
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.payload_bytes = 0
+        self.cache = {}
+        self.errors = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+    def add(self, span):
+        self.count += 1
+        self.total += span.duration
+        self.max = max(self.max, span.duration)
+        self.payload_bytes += span.payload_bytes
+        if span.cache is not None:
+            self.cache[span.cache] = self.cache.get(span.cache, 0) + 1
+        if span.error is not None:
+            self.errors += 1
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if span.duration <= bound:
+                self.buckets[i] += 1
+
+    def to_dict(self):
+        lookups = sum(self.cache.values())
+        hits = lookups - self.cache.get('miss', 0)
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 4),
+            'mean_s': round(self.total / self.count, 4) if self.count else 0.0,
+            'max_s': round(self.max, 4),
+            'payload_bytes': self.payload_bytes,
+            'cache': dict(self.cache),
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+            'errors': self.errors
+        }
+
+class Metrics:
+    """Per stage aggregation of spans, used both for a single generation run and for the whole process."""
+
+    def __init__(self, name=None, keep_spans=False):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.runs = 0
+        self.stages = {}
+        self.spans = [] if keep_spans else None
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.stages.setdefault(span.stage, StageStats()).add(span)
+            if self.spans is not None:
+                self.spans.append(span)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def summary(self):
+        with self._lock:
+            return {stage: stats.to_dict() for stage, stats in sorted(self.stages.items())}
+
+    def to_json(self):
+        data = {'name': self.name, 'started': self.started, 'elapsed_s': round(self.elapsed, 4), 'stages': self.summary()}
+        if self.spans is None:
+            data['runs'] = self.runs
+        else:
+            with self._lock:
+                data['spans'] = [span.to_dict() for span in self.spans]
+        return json.dumps(data, indent=2)
+
+    def to_prometheus(self, prefix='triptailor'):
+        lines = [
+            f"# HELP {prefix}_stage_duration_seconds Time spent per stage.",
+            f"# TYPE {prefix}_stage_duration_seconds histogram"
+        ]
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for stage, stats in stages:
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    lines.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {stats.count}')
+                lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{stage}"}} {stats.total:.6f}')
+                lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{stage}"}} {stats.count}')
+
+            lines += [f"# HELP {prefix}_stage_payload_bytes_total Response bytes received per stage.",
+                      f"# TYPE {prefix}_stage_payload_bytes_total counter"]
+            lines += [f'{prefix}_stage_payload_bytes_total{{stage="{stage}"}} {stats.payload_bytes}' for stage, stats in stages]
+
+            lines += [f"# HELP {prefix}_stage_cache_total Cache lookups per stage and result.",
+                      f"# TYPE {prefix}_stage_cache_total counter"]
+            lines += [f'{prefix}_stage_cache_total{{stage="{stage}",result="{result}"}} {count}'
+                      for stage, stats in stages for result, count in sorted(stats.cache.items())]
+
+            lines += [f"# HELP {prefix}_stage_errors_total Failed calls per stage.",
+                      f"# TYPE {prefix}_stage_errors_total counter"]
+            lines += [f'{prefix}_stage_errors_total{{stage="{stage}"}} {stats.errors}' for stage, stats in stages]
+
+        lines += [f"# HELP {prefix}_runs_total Generation runs recorded.",
+                  f"# TYPE {prefix}_runs_total counter",
+                  f"{prefix}_runs_total {self.runs}"]
+        return "\n".join(lines) + "\n"
+
+# Everything recorded since the process started
+process_metrics = Metrics('process')
+
+def record(span):
+    process_metrics.add(span)
+    run = current_run.get()
+    if run is not None:
+        run.add(span)
+
+@contextmanager
+def span(stage, cached=False):
+    """
+    Time the block as one span of `stage`. With cached=True the block calls a cached function:
+    the span counts as a cache hit unless the function body reports otherwise through annotate().
+    """
+    current = Span(stage)
+    token = current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # A streaming generator closed from another thread
+            pass
+        if cached and current.cache is None:
+            current.cache = 'hit'
+        record(current)
+
+def annotate(**fields):
+    # Set fields (cache, payload_bytes, error) on the innermost open span, if any
+    current = current_span.get()
+    if current is not None:
+        for name, value in fields.items():
+            setattr(current, name, value)
+
+def timed(stage, cached=False):
+    # Decorator form of span(), put it above @st.cache_data to also count cache hits
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, cached=cached):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(stage, cache=None, n=1):
+    # Record n instantaneous spans, e.g. lookups answered from a cache without a call
+    for _ in range(n):
+        record(Span(stage, cache))
+
+def observe(stage, duration):
+    # Record a span measured elsewhere, e.g. time spent queued for a rate limiter
+    current = Span(stage)
+    current.duration = duration
+    record(current)
+
+@contextmanager
+def run_metrics(name):
+    """Collect every span recorded by this block (and the tasks it submits) into a new Metrics."""
+    run = Metrics(name, keep_spans=True)
+    token = current_run.set(run)
+    try:
+        yield run
+    finally:
+        run.finished = time.time()
+        current_run.reset(token)
+        with process_metrics._lock:
+            process_metrics.runs += 1
+
+def submit(executor, func, *args, **kwargs):
+    # executor.submit that runs the task in a copy of the caller's context, so its spans reach the caller's run
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
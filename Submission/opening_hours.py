@@ -0,0 +1,109 @@
+from bisect import bisect_right
+from datetime import date as date_type, datetime, timedelta
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# Night activities before noon happen after midnight, on the day after the itinerary date
+NIGHT_ROLLOVER = "12:00"
+
+HOURS_NOT_AVAILABLE = "Opening hours not available"
+CLOSED = "Closed"
+
+def google_weekday(day):
+    # Places periods number the days from Sunday (0), Python's weekday() from Monday (0)
+    return (day.weekday() + 1) % 7
+
+def parse_minutes(hhmm):
+    return int(hhmm[:2]) * 60 + int(hhmm[2:])
+
+def format_time(minutes):
+    return datetime(2000, 1, 1, minutes // 60, minutes % 60).strftime("%I:%M %p")
+
+def compile_opening_hours(opening_hours):
+    """
+    Compile Places `opening_hours.periods` into a weekly index, once per place:
+
+        {"intervals": [[start, end], ...], "display": [7 strings]}
+
+    Intervals are sorted, merged, non-overlapping minutes of the week counted from Sunday 00:00,
+    with periods running past Saturday midnight split at the end of the week. Display holds the
+    text shown for each Google weekday. Returns None if the place has no periods.
+    """
+    periods = (opening_hours or {}).get('periods')
+    if not periods:
+        return None
+
+    intervals = []
+    display = [[] for _ in range(7)]
+    for period in periods:
+        open_day = period['open']['day']
+        open_minute = parse_minutes(period['open']['time'])
+        if 'close' not in period:
+            # A single period without a close time means open 24/7
+            return {"intervals": [[0, MINUTES_PER_WEEK]], "display": [f"{format_time(open_minute)} - Open 24 hours"] * 7}
+
+        close_minute = parse_minutes(period['close']['time'])
+        start = open_day * MINUTES_PER_DAY + open_minute
+        end = period['close']['day'] * MINUTES_PER_DAY + close_minute
+        if end <= start:
+            end += MINUTES_PER_WEEK
+        if end > MINUTES_PER_WEEK:
+            intervals += [[start, MINUTES_PER_WEEK], [0, end - MINUTES_PER_WEEK]]
+        else:
+            intervals.append([start, end])
+        display[open_day].append((open_minute, f"{format_time(open_minute)} - {format_time(close_minute)}"))
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return {
+        "intervals": merged,
+        "display": [", ".join(text for _, text in sorted(day)) or CLOSED for day in display]
+    }
+
+def weekly_hours(place):
+    # Places cached before the index existed get it compiled on first use
+    if 'weekly_hours' not in place:
+        place['weekly_hours'] = compile_opening_hours(place.get('opening_hours'))
+    return place['weekly_hours']
+
+def display_hours(place, date):
+    hours = weekly_hours(place)
+    if hours is None:
+        return HOURS_NOT_AVAILABLE
+    return hours['display'][google_weekday(to_date(date))]
+
+def activity_datetime(date, activity_time, night=False):
+    day = to_date(date)
+    if night and activity_time < NIGHT_ROLLOVER:
+        day += timedelta(days=1)
+    return datetime.combine(day, datetime.strptime(activity_time, "%H:%M").time())
+
+def is_open(place, when):
+    """True if the place is open at the datetime `when`, None if its hours are unknown."""
+    hours = weekly_hours(place)
+    if hours is None:
+        return None
+    minute = google_weekday(when) * MINUTES_PER_DAY + when.hour * 60 + when.minute
+    intervals = hours['intervals']
+    i = bisect_right(intervals, [minute, MINUTES_PER_WEEK + 1]) - 1
+    return i >= 0 and intervals[i][0] <= minute < intervals[i][1]
+
+def check_activities(activities, date, night=False):
+    # Open at visit time for every activity of a day, in order
+    results = []
+    for activity in activities:
+        try:
+            when = activity_datetime(date, activity['time'], night)
+        except ValueError:
+            results.append(None)
+            continue
+        results.append(is_open(activity['place'], when))
+    return results
+
+def to_date(value):
+    return value if isinstance(value, date_type) else datetime.strptime(value, "%Y-%m-%d").date()
@@ -1,94 +1,45 @@
 import streamlit as st
-import requests
+import config
+import http_client
 import json
-import pandas as pd
-from google.oauth2.service_account import Credentials
-import google.auth.transport.requests
-import pygsheets
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, landscape
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from io import BytesIO
-
-pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
-pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
-
-@st.cache_data(ttl=3600,show_spinner=False)
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import mailer
+from pdf_engine import itinerary_rows, submit_pdf
+
+# Spreadsheet the Apps Script mailer reads the exported itineraries from
+SHEET_ID = '1Mw_kkGf8Z5qN2RGhOzIM04zEN30cZIznrOfjWPwNluc'
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+# Rows of Base_Day (header included) overwritten by every export
+BASE_DAY_ROWS = 500
+
+# Exports share one spreadsheet, so they run one at a time, in order, off the UI thread
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+_token_lock = threading.Lock()
+
+@metrics.timed('pdf', cached=True)
 def create_itinerary_pdf(itinerary, set_number, itinerary_number, mode_of_transport):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=landscape(letter), rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    elements = []
-    header_color = colors.HexColor('#1C4E80')  # Deep blue
-    row_color1 = colors.HexColor('#F0F7FF')    # Very light blue
-    row_color2 = colors.HexColor('#FFFFFF')    # White
-    title_color = colors.HexColor('#0A2C4E')   # Darker blue for titles
-    border_color = colors.HexColor('#7AA5C9')  # Light blue for borders
-
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='Center', alignment=1, fontName='DejaVuSans', textColor=title_color))
-    styles.add(ParagraphStyle(name='Small', fontSize=8, fontName='DejaVuSans'))
-    styles.add(ParagraphStyle(name='Thank You', fontSize=14, alignment=1, spaceAfter=12, fontName='DejaVuSans', textColor=title_color))
-    styles.add(ParagraphStyle(name='Info', fontSize=10, alignment=1, spaceAfter=12, fontName='DejaVuSans', textColor=colors.HexColor('#1C4E80')))
-    # Add thank you message
-    elements.append(Paragraph("Thank you for using TripTailorAI!", styles['Thank You']))
-    elements.append(Spacer(1, 12))
-
-    elements.append(Paragraph(f"Itinerary {itinerary_number} from Set {set_number}", styles['Heading1']))
-    elements.append(Spacer(1, 12))
+    # Bytes of the PDF of one itinerary version
+    return render_pdf(f"Itinerary {itinerary_number} from Set {set_number}", [(None, itinerary_rows(itinerary))])
 
-    for day in itinerary:
-        elements.append(Paragraph(f"Date: {day['date']}", styles['Heading2']))
-        elements.append(Paragraph(f"Weather forecast: {day['weather']}", styles['Normal']))
-        elements.append(Spacer(1, 12))
+@metrics.timed('pdf', cached=True)
+def create_itinerary_set_pdf(itinerary_set, set_number):
+    # Every day and night version of a set in one document, one version per page
+    sections = [(f"Version {number} - Day", itinerary_rows(itinerary)) for number, itinerary in enumerate(itinerary_set['day'], 1)]
+    sections += [(f"Version {number} - Night", itinerary_rows(itinerary)) for number, itinerary in enumerate(itinerary_set.get('night') or [], 1)]
+    return render_pdf(f"Itineraries from Set {set_number}", sections)
 
-        data = [['Time', 'Activity', 'Place', 'Address', 'Opening Hours', 'Travel Time']]
-        for i, activity in enumerate(day['activities']):
-            row = [
-                Paragraph(activity['time'], styles['Small']),
-                Paragraph(activity['activity'], styles['Small']),
-                Paragraph(activity['place']['name'], styles['Small']),
-                Paragraph(activity['place']['formatted_address'], styles['Small']),
-                Paragraph(activity.get('opening_hours', 'N/A'), styles['Small']),
-                Paragraph(activity.get('duration_to_next', 'N/A') if i < len(day['activities']) - 1 else 'N/A', styles['Small'])
-            ]
-            data.append(row)
-
-        table = Table(data, colWidths=[0.5*inch, 1.8*inch, 1.5*inch, 2.5*inch, 1.5*inch, 1*inch])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), header_color),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('FONTNAME', (0, 0), (-1, 0), 'DejaVuSans-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), row_color1),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'DejaVuSans'),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('TOPPADDING', (0, 1), (-1, -1), 3),
-            ('BOTTOMPADDING', (0, 1), (-1, -1), 3),
-            ('GRID', (0, 0), (-1, -1), 1, border_color),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [row_color1, row_color2])
-        ]))
-        elements.append(table)
-        elements.append(Spacer(1, 12))
-
-    info_text = "Did you know that if you press the 'Send all itineraries' button, you'll get all of your itineraries in your email?"
-    elements.append(Paragraph(info_text, styles['Info']))
-
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+def render_pdf(title, sections):
+    # Documents are cached by the fingerprint of their text, rendering happens in the PDF process pool
+    future, cached = submit_pdf(title, sections)
+    data = future.result()
+    if not cached:
+        metrics.annotate(cache='miss', payload_bytes=len(data))
+    return data
 
-# @st.cache_data(ttl=3600)
-def display_itinerary(itinerary, set_number, itinerary_number, mode_of_transport,email_address,destination,start_date,end_date):
+def itinerary_markdown(itinerary, mode_of_transport):
     itinerary_message = ""
-    day_data = []
     for day in itinerary:
         date = day['date']
         weather = day['weather']
@@ -103,7 +54,8 @@ def display_itinerary(itinerary, set_number, itinerary_number, mode_of_transport
             activity_url = activity['place'].get('url')
             itinerary_message += f"- {time}: {activity_name} at [{place_name}]({activity_url})\n"
             itinerary_message += f"  - Address: {address}\n"
-            itinerary_message += f"  - Opening Hours: {opening_hours}\n"
+            closed_note = " ⚠️ May be closed at this time" if activity.get('open_at_visit') is False else ""
+            itinerary_message += f"  - Opening Hours: {opening_hours}{closed_note}\n"
             if i < len(day['activities']) - 1:
                 duration_value = activity.get('duration_to_next_value', float('inf'))
                 duration_text = activity.get('duration_to_next', 'N/A')
@@ -114,34 +66,45 @@ def display_itinerary(itinerary, set_number, itinerary_number, mode_of_transport
                 else:
                     color = 'red'
                 itinerary_message += f"  - :clock3: Travel time to next location ({mode_of_transport[:-8]}): <font color='{color}'>{duration_text}</font>\n"
-            
-            day_data.append([date, weather, time, activity_name, place_name, address, opening_hours])
-        
+
         itinerary_message += "---\n\n"
-    
+    return itinerary_message
+
+def rendered_itinerary(itinerary_set, part, itinerary_number):
+    """
+    Markdown of one version ('day' or 'night') of a generated set. Sets don't change once
+    generated, so it is built on first display and kept in the set for every later rerun.
+    """
+    rendered = itinerary_set.setdefault('markdown', {})
+    key = f"{part}_{itinerary_number}"
+    if key not in rendered:
+        rendered[key] = itinerary_markdown(itinerary_set[part][itinerary_number - 1], itinerary_set['trip_details']['mode_of_transport'])
+    return rendered[key]
+
+def display_itinerary(itinerary, set_number, itinerary_number, mode_of_transport,email_address,destination,start_date,end_date,itinerary_message=None):
+    if itinerary_message is None:
+        itinerary_message = itinerary_markdown(itinerary, mode_of_transport)
     st.markdown(itinerary_message, unsafe_allow_html=True)
     
     col1, col2 = st.columns(2)
     with col1:
         if st.button(f"Export Itinerary {itinerary_number} as PDF 📄", key=f"export_pdf_{set_number}_{itinerary_number}_{id(itinerary)}"):
-            pdf_buffer = create_itinerary_pdf(itinerary, set_number, itinerary_number, mode_of_transport)
+            pdf_data = create_itinerary_pdf(itinerary, set_number, itinerary_number, mode_of_transport)
             st.download_button(
                 label="Download PDF",
-                data=pdf_buffer,
+                data=pdf_data,
                 file_name=f"itinerary_{set_number}_{itinerary_number}.pdf",
                 mime="application/pdf"
             )
             st.success(f"Itinerary {itinerary_number} from Set {set_number} exported as PDF.")
     with col2:
         if st.button(f"Send Itinerary {itinerary_number} via Email 📧", key=f"send_email_{set_number}_{itinerary_number}_{id(itinerary)}"):
-            send_to_gsheets(email_address,destination,start_date,end_date)
-            send_email(['V'+str(itinerary_number)])
-            st.success(f"Itinerary {itinerary_number} from Set {set_number} sent via email.")
-    
-    return day_data
+            queue_export(['V'+str(itinerary_number)], email_address, destination, start_date, end_date, f"Itinerary {itinerary_number} from Set {set_number} sent via email.")
 
 # @st.cache_data(ttl=3600)
 def generate_df(itinerary_set):
+    # pandas, pygsheets and google-auth are imported by the exports using them, not when the page loads
+    import pandas as pd
     itinerary_data = []
     columns = ['itinerary_version', 'date', 'weather', 'time', 'activity', 'place', 'MapsLink', 'Address', 'Hours']
     
@@ -182,56 +145,85 @@ def generate_df(itinerary_set):
     df = pd.DataFrame(itinerary_data, columns=columns)
     return df
 
-@st.cache_data(ttl=3600,show_spinner=False)
-def send_to_gsheets(email_address,destination,start_date,end_date):
-    if st.session_state.all_generated_itineraries:
-        most_recent_set = st.session_state.all_generated_itineraries[-1]
-        df = generate_df(most_recent_set)
-        
-        service_account_info = st.secrets["gcp_service_account"]
-        
-        # Create credentials object
-        credentials = Credentials.from_service_account_info(
-            service_account_info,
-            scopes=['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        )
-        
-        # Authorize with pygsheets using the credentials
-        gc = pygsheets.authorize(custom_credentials=credentials)
-        
-        # Rest of your function remains the same
-        sheet_id = '1Mw_kkGf8Z5qN2RGhOzIM04zEN30cZIznrOfjWPwNluc'
-        worksheet_name = 'Base_Day'
-        sh = gc.open_by_key(sheet_id)
-        wks = sh.worksheet_by_title(worksheet_name)  # Select the first sheet
-        start_cell = 'C2'
-        end_cell = 'K500'
-        wks.clear(start=start_cell, end=end_cell)
-        wks.set_dataframe(df, (1, 3))
-        worksheet_name = 'Master'
-        wks = sh.worksheet_by_title(worksheet_name)  # Select the first sheet
-        wks.update_value("B1", email_address)
-        wks.update_value("B2", destination)
-        wks.update_value("B3", start_date.strftime("%Y-%m-%d"))
-        wks.update_value("B4", end_date.strftime("%Y-%m-%d"))
-        return True
-    else:
+@st.cache_resource(show_spinner=False)
+def sheets_client():
+    # One authorized client per process, its credentials refresh their token only once it has expired
+    import pygsheets
+    from google.oauth2.service_account import Credentials
+    credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=SHEETS_SCOPES)
+    return pygsheets.authorize(custom_credentials=credentials)
+
+@st.cache_resource(show_spinner=False)
+def apps_script_credentials():
+    from google.oauth2.service_account import Credentials
+    return Credentials.from_service_account_info(st.secrets["gcp_service_email"], scopes=["https://www.googleapis.com/auth/drive.readonly"])
+
+def sheet_values(df):
+    # Header and rows of the data block, padded with blanks so the previous export is overwritten in the same update
+    values = [list(df.columns)] + [['' if value is None else value for value in row] for row in df.itertuples(index=False)]
+    values += [[''] * len(df.columns)] * (BASE_DAY_ROWS - len(values))
+    return values
+
+@metrics.timed('sheets')
+def send_to_gsheets(itinerary_set, email_address, destination, start_date, end_date):
+    """Write an itinerary set and the Master header cells to the spreadsheet read by the mailer, in one batched update."""
+    if not itinerary_set:
         return False
+    df = generate_df(itinerary_set)
+    metrics.annotate(payload_bytes=int(df.memory_usage(deep=True).sum()))
+    body = {
+        'valueInputOption': 'USER_ENTERED',
+        'data': [
+            {'range': f"Base_Day!C1:K{max(BASE_DAY_ROWS, len(df) + 1)}", 'values': sheet_values(df)},
+            {'range': 'Master!B1:B4', 'values': [[email_address], [destination], [start_date.strftime("%Y-%m-%d")], [end_date.strftime("%Y-%m-%d")]]}
+        ]
+    }
+    sheets_client().sheet.service.spreadsheets().values().batchUpdate(spreadsheetId=SHEET_ID, body=body).execute(num_retries=config.HTTP_RETRIES)
+    return True
 
 
 def getAccessToken():
-    service_account_email = st.secrets["gcp_service_email"]
-    # SERVICE_ACCOUNT_FILE = "sheets-drive-api-1-7785bd353bca.json" # Please set your value.
-    # creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/drive.readonly"])
-    creds = Credentials.from_service_account_info(service_account_email,scopes=["https://www.googleapis.com/auth/drive.readonly"])
-    creds.refresh(google.auth.transport.requests.Request())
-    return creds.token
+    # Refreshed only when there is no token yet or it is about to expire
+    import google.auth.transport.requests
+    creds = apps_script_credentials()
+    with _token_lock:
+        if not creds.valid:
+            creds.refresh(google.auth.transport.requests.Request(session=http_client.session()))
+        return creds.token
     
 # @st.cache_data(ttl=3600)
+@metrics.timed('email')
 def send_email(arguments):
     functionName = "maincall"
     webApps_url = 'https://script.google.com/macros/s/AKfycbxL1kUB-TaP6oFEpZgFzAUhOvtHm6bnDgaPpcNZ-xA/dev'
     access_token = getAccessToken()
     url = f'{webApps_url}?functionName={functionName}'
-    res = requests.post(url, json.dumps(arguments), headers={"Authorization": "Bearer " + access_token})
-    print(res.text)
\ No newline at end of file
+    res = http_client.post(url, json.dumps(arguments), headers={"Authorization": "Bearer " + access_token},
+                           timeout=(config.HTTP_CONNECT_TIMEOUT, config.APPS_SCRIPT_TIMEOUT))
+    print(res.text)
+
+def export_itineraries(itinerary_set, email_address, destination, start_date, end_date, arguments):
+    # Sheet then email, the mailer reads what was just written
+    if not send_to_gsheets(itinerary_set, email_address, destination, start_date, end_date):
+        return False
+    send_email(arguments)
+    return True
+
+def submit_export(itinerary_set, email_address, destination, start_date, end_date, arguments):
+    """Queue an export on the export thread, returns a future with True once sent, False if there was nothing to send."""
+    return metrics.submit(export_executor, export_itineraries, itinerary_set, email_address, destination, start_date, end_date, arguments)
+
+def queue_export(arguments, email_address, destination, start_date, end_date, success_message):
+    # The most recent set is sent by the outbox, or through the Apps Script on the export thread. The page reports the outcome once it is done
+    itinerary_sets = st.session_state.all_generated_itineraries
+    if not mailer.is_email_address(email_address):
+        st.error("Error: Please enter a valid email address.")
+    elif config.MAIL_TRANSPORT == 'apps_script':
+        future = submit_export(itinerary_sets[-1] if itinerary_sets else None, email_address, destination, start_date, end_date, arguments)
+        st.session_state.pending_exports.append({'future': future, 'success': success_message})
+    elif not itinerary_sets:
+        st.sidebar.error("No itineraries to export. Please generate an itinerary first.")
+    else:
+        versions = [int(argument.lstrip('V')) for argument in arguments]
+        job_id = mailer.queue_email(itinerary_sets[-1], st.session_state.itinerary_set_count, email_address, versions)
+        st.session_state.pending_exports.append({'job': job_id, 'success': success_message})
@@ -0,0 +1,183 @@
+import config
+import hashlib
+import json
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+HEADER = ('Time', 'Activity', 'Place', 'Address', 'Opening Hours', 'Travel Time')
+# In inches. reportlab is imported by the functions rendering a document, so the page doesn't wait for it
+COLUMN_WIDTHS = (0.5, 1.8, 1.5, 2.5, 1.5, 1)
+THANK_YOU = "Thank you for using TripTailorAI!"
+INFO_TEXT = "Did you know that if you press the 'Send all itineraries' button, you'll get all of your itineraries in your email?"
+
+def register_fonts():
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
+    pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
+
+def build_templates():
+    """Paragraph styles and the table style shared by every document rendered in this process."""
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import TableStyle
+    header_color = colors.HexColor('#1C4E80')  # Deep blue
+    row_color1 = colors.HexColor('#F0F7FF')    # Very light blue
+    row_color2 = colors.HexColor('#FFFFFF')    # White
+    title_color = colors.HexColor('#0A2C4E')   # Darker blue for titles
+    border_color = colors.HexColor('#7AA5C9')  # Light blue for borders
+
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name='Center', alignment=1, fontName='DejaVuSans', textColor=title_color))
+    styles.add(ParagraphStyle(name='Small', fontSize=8, fontName='DejaVuSans'))
+    styles.add(ParagraphStyle(name='Thank You', fontSize=14, alignment=1, spaceAfter=12, fontName='DejaVuSans', textColor=title_color))
+    styles.add(ParagraphStyle(name='Info', fontSize=10, alignment=1, spaceAfter=12, fontName='DejaVuSans', textColor=colors.HexColor('#1C4E80')))
+
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), header_color),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('FONTNAME', (0, 0), (-1, 0), 'DejaVuSans-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), row_color1),
+        ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+        ('FONTNAME', (0, 1), (-1, -1), 'DejaVuSans'),
+        ('FONTSIZE', (0, 1), (-1, -1), 8),
+        ('TOPPADDING', (0, 1), (-1, -1), 3),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 3),
+        ('GRID', (0, 0), (-1, -1), 1, border_color),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [row_color1, row_color2])
+    ])
+    return styles, table_style
+
+_templates = None
+_templates_lock = threading.Lock()
+
+def templates():
+    global _templates
+    with _templates_lock:
+        if _templates is None:
+            register_fonts()
+            _templates = build_templates()
+        return _templates
+
+def itinerary_rows(itinerary):
+    """
+    The text a document shows for one itinerary: ((date, weather, (row, ...)), ...). Plain
+    tuples of strings, cheap to fingerprint and to send to a rendering process.
+    """
+    days = []
+    for day in itinerary:
+        activities = day['activities']
+        days.append((day['date'], day['weather'], tuple(
+            (activity['time'], activity['activity'], activity['place']['name'], activity['place']['formatted_address'],
+             activity.get('opening_hours', 'N/A'), activity.get('duration_to_next', 'N/A') if i < len(activities) - 1 else 'N/A')
+            for i, activity in enumerate(activities)
+        )))
+    return tuple(days)
+
+def fingerprint(title, sections):
+    return hashlib.sha1(json.dumps([title, sections]).encode()).hexdigest()
+
+def render(title, sections, document_templates=None):
+    """
+    Render a document in one pass and return its bytes. sections is a sequence of
+    (heading, itinerary_rows) rendered one after the other, each from a new page.
+    """
+    from reportlab.lib.pagesizes import letter, landscape
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, PageBreak
+    styles, table_style = document_templates or templates()
+    small = styles['Small']
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(letter), rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
+    elements = [Paragraph(THANK_YOU, styles['Thank You']), Spacer(1, 12)]
+    if title:
+        elements += [Paragraph(escape(title), styles['Heading1']), Spacer(1, 12)]
+
+    for number, (heading, days) in enumerate(sections):
+        if number:
+            elements.append(PageBreak())
+        if heading:
+            elements += [Paragraph(escape(heading), styles['Heading1']), Spacer(1, 12)]
+        for date, weather, rows in days:
+            elements.append(Paragraph(f"Date: {escape(date)}", styles['Heading2']))
+            elements.append(Paragraph(f"Weather forecast: {escape(weather)}", styles['Normal']))
+            elements.append(Spacer(1, 12))
+            # The time fits its column as it is, every other cell is a wrapping paragraph
+            data = [list(HEADER), *[[time, *[Paragraph(escape(str(cell)), small) for cell in cells]] for time, *cells in rows]]
+            table = Table(data, colWidths=[width * inch for width in COLUMN_WIDTHS])
+            table.setStyle(table_style)
+            elements.append(table)
+            elements.append(Spacer(1, 12))
+
+    elements.append(Paragraph(INFO_TEXT, styles['Info']))
+    doc.build(elements)
+    return buffer.getvalue()
+
+_executor = None
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+def pdf_executor():
+    # Spawned rather than forked, the web process runs many threads
+    global _executor
+    with _lock:
+        if _executor is None and config.PDF_WORKERS > 0:
+            _executor = ProcessPoolExecutor(max_workers=config.PDF_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+def cached_pdf(key):
+    with _lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+        return data
+
+def store_pdf(key, data):
+    global _cache_bytes
+    with _lock:
+        if key in _cache:
+            return
+        _cache[key] = data
+        _cache_bytes += len(data)
+        while _cache_bytes > config.PDF_CACHE_MAX_BYTES and len(_cache) > 1:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+def submit_pdf(title, sections):
+    """Future with the bytes of the document, rendered by the process pool unless it is cached. Returns (future, cached)."""
+    sections = tuple(sections)
+    key = fingerprint(title, sections)
+    data = cached_pdf(key)
+    if data is not None:
+        future = Future()
+        future.set_result(data)
+        return future, True
+
+    def remember(done):
+        if not done.cancelled() and done.exception() is None:
+            store_pdf(key, done.result())
+
+    executor = pdf_executor()
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(render(title, sections))
+        except Exception as e:
+            future.set_exception(e)
+    else:
+        future = executor.submit(render, title, sections)
+    future.add_done_callback(remember)
+    return future, False
+
+def pdf_cache_stats():
+    with _lock:
+        return {'documents': len(_cache), 'bytes': _cache_bytes}
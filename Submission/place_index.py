@@ -0,0 +1,142 @@
+import streamlit as st
+import math
+import re
+import threading
+import unicodedata
+import config
+from disk_cache import DiskCache
+
+# Width in degrees of the grid cells places are bucketed in, about 1 km of latitude
+GRID_CELL_DEGREES = 0.01
+EARTH_RADIUS_KM = 6371.0
+
+# Articles dropped from the front of a name, so "The Louvre" and "Louvre" are the same alias
+LEADING_ARTICLES = {'the', 'le', 'la', 'les', 'l', 'el', 'il', 'lo', 'der', 'die', 'das', 'de', 'het'}
+
+@st.cache_resource(show_spinner=False)
+def place_index_cache():
+    # Resolved places keyed by destination and alias, shared through CACHE_DIR like the places cache
+    return DiskCache('place_index', ttl=config.PLACES_CACHE_TTL, max_bytes=config.PLACE_INDEX_MAX_BYTES)
+
+@st.cache_resource(show_spinner=False)
+def destination_cache():
+    # [lat, lng] centre per location ("destination, country"), from a geocode of the location itself
+    return DiskCache('destination_centres', ttl=config.PLACES_CACHE_TTL)
+
+def normalize_query(query):
+    # Fold case, accents, punctuation and whitespace so "Louvre in Paris, France" and "louvre  in paris france" match
+    query = unicodedata.normalize('NFKD', query.casefold())
+    query = ''.join(c for c in query if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^\w\s]', ' ', query).split())
+
+def place_alias(name):
+    words = normalize_query(name).split()
+    while len(words) > 1 and words[0] in LEADING_ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+def distance_km(lat1, lng1, lat2, lng2):
+    # Haversine great-circle distance
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def place_coordinates(place):
+    location = (place or {}).get('location')
+    if location and location.get('lat') is not None and location.get('lng') is not None:
+        return location['lat'], location['lng']
+    return None
+
+class DestinationIndex:
+    """
+    Places resolved for one destination in this process, bucketed in a grid by coordinates.
+    Aliases themselves live in place_index_cache so they survive restarts and are shared.
+    """
+
+    def __init__(self):
+        self.grid = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cell(lat, lng):
+        return int(math.floor(lat / GRID_CELL_DEGREES)), int(math.floor(lng / GRID_CELL_DEGREES))
+
+    def add(self, place):
+        coordinates = place_coordinates(place)
+        if coordinates is None:
+            return
+        with self._lock:
+            bucket = self.grid.setdefault(self.cell(*coordinates), [])
+            if not any(existing['formatted_address'] == place['formatted_address'] for existing in bucket):
+                bucket.append(place)
+
+    def nearby(self, lat, lng, radius_km):
+        # Only the cells overlapping the radius are scanned
+        reach_lat = math.ceil(radius_km / 111.0 / GRID_CELL_DEGREES)
+        reach_lng = math.ceil(radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01)) / GRID_CELL_DEGREES)
+        row, column = self.cell(lat, lng)
+        found = []
+        with self._lock:
+            for i in range(row - reach_lat, row + reach_lat + 1):
+                for j in range(column - reach_lng, column + reach_lng + 1):
+                    for place in self.grid.get((i, j), ()):
+                        if distance_km(lat, lng, *place_coordinates(place)) <= radius_km:
+                            found.append(place)
+        return found
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self.grid.values())
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def destination_index(location):
+    key = normalize_query(location)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = DestinationIndex()
+        return _indexes[key]
+
+def lookup_place(name, location):
+    # Details of a place already resolved under this alias for the destination, or None
+    alias = place_alias(name)
+    if not alias:
+        return None
+    place = place_index_cache().get(f"{normalize_query(location)}|{alias}")
+    if place is not None:
+        destination_index(location).add(place)
+    return place
+
+def add_place(name, location, place):
+    """Index a resolved place under the name it was searched for and the name Places returned."""
+    if place_coordinates(place) is None:
+        # Fallback details without a real match are never indexed
+        return
+    for alias in {place_alias(name), place_alias(place['name'])} - {''}:
+        place_index_cache().set(f"{normalize_query(location)}|{alias}", place)
+    destination_index(location).add(place)
+
+def set_destination_centre(location, lat, lng):
+    destination_cache().set(normalize_query(location), [lat, lng])
+
+def destination_centre(location):
+    # Keyed on the country too, "Paris, United States" does not get the centre of Paris, France
+    return destination_cache().get(normalize_query(location))
+
+def within_destination(place, location, radius_km=None):
+    """
+    Whether the place lies within radius_km (by default DESTINATION_RADIUS_KM) of the centre of the
+    location. When the location could not be geocoded, whether it lies within radius_km of a place
+    already resolved for it. None when the place has no coordinates or nothing is known about the location.
+    """
+    radius_km = config.DESTINATION_RADIUS_KM if radius_km is None else radius_km
+    coordinates = place_coordinates(place)
+    if coordinates is None:
+        return None
+    centre = destination_centre(location)
+    if centre is not None:
+        return distance_km(*coordinates, *centre) <= radius_km
+    if len(destination_index(location)):
+        return bool(destination_index(location).nearby(*coordinates, radius_km))
+    return None
@@ -1,24 +1,99 @@
 import streamlit as st
 import requests
-import google.generativeai as genai
+import http_client
+import config
 from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from disk_cache import DiskCache
+from opening_hours import compile_opening_hours
+from place_index import normalize_query, lookup_place, add_place, within_destination, destination_centre, set_destination_centre, place_coordinates
+from singleflight import SingleFlight
+from rate_limit import PREFETCH, places_limiter, weather_limiter
+import metrics
+import jobs
 
-GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
-genai.configure(api_key=GOOGLE_API_KEY)
-google_places_api_key = st.secrets['MAPS_API_KEY']
-weather_api_key = st.secrets['WEATHER']
+@st.cache_resource(show_spinner=False)
+def places_slots():
+    # Places text searches in flight at once (PLACES_MAX_CONCURRENCY), shared by every session in the process
+    return threading.BoundedSemaphore(config.PLACES_MAX_CONCURRENCY)
 
+@st.cache_resource(show_spinner=False)
+def places_executor():
+    return ThreadPoolExecutor(max_workers=config.PLACES_MAX_CONCURRENCY, thread_name_prefix='places')
+
+@st.cache_resource(show_spinner=False)
+def places_cache():
+    # Persistent place store shared across sessions, restarts and replicas using the same CACHE_DIR
+    return DiskCache('places', ttl=config.PLACES_CACHE_TTL, max_bytes=config.PLACES_CACHE_MAX_BYTES)
+
+@st.cache_resource(show_spinner=False)
+def weather_cache():
+    # {date: summary} indexes per city, shared the same way as places
+    return DiskCache('weather', ttl=config.WEATHER_CACHE_TTL, max_bytes=config.WEATHER_CACHE_MAX_BYTES)
+
+# Days of forecast requested per city
+WEATHER_FORECAST_DAYS = 14
+# weatherapi.com accepts at most 50 locations per bulk request
+WEATHER_BULK_LIMIT = 50
+WEATHER_UNAVAILABLE = "Weather data not available"
+
+# Sessions missing the caches for the same place or city at the same time share one upstream call
+place_flight = SingleFlight('places')
+weather_flight = SingleFlight('weather')
+destination_flight = SingleFlight('destinations')
+
+@metrics.timed('places', cached=True)
 @st.cache_data(ttl=3600,show_spinner=False)
 def get_place_details(query, location, radius=5000, min_rating=2.5, min_reviews=5):
-    url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+    cache_key = f"{normalize_query(query)}|{normalize_query(location)}|{radius}|{min_rating}|{min_reviews}"
+    details = places_cache().get(cache_key)
+    if details is not None:
+        metrics.annotate(cache='disk')
+        return details
+
+    # A venue already resolved for this destination under the same name needs no search
+    details = lookup_place(query.split(" in ")[0], location)
+    if details is not None:
+        metrics.annotate(cache='index')
+        places_cache().set(cache_key, details)
+        return details
+
+    details, shared = place_flight.do(cache_key, resolve_place, cache_key, query, location, radius, min_rating, min_reviews)
+    metrics.annotate(cache='coalesced' if shared else 'miss')
+    return details
+
+def resolve_place(cache_key, query, location, radius, min_rating, min_reviews):
+    details, cacheable = search_place(query, location, radius, min_rating, min_reviews)
+    if cacheable:
+        places_cache().set(cache_key, details)
+        add_place(query.split(" in ")[0], location, details)
+    return details
+
+def search_place(query, location, radius, min_rating, min_reviews):
+    # Returns the place details and whether the answer is safe to cache (not an API error)
+    url = f"{config.MAPS_API_URL}/place/textsearch/json"
     params = {
         'query': query,
         'location': location,
         'radius': radius,
-        'key': google_places_api_key
+        'key': config.maps_api_key()
     }
-    response = requests.get(url, params=params)
-    places = response.json().get('results', [])
+    try:
+        # Wait for the quota before taking a slot, so queued lookups don't hold connections
+        places_limiter().acquire()
+        with places_slots():
+            response = http_client.get(url, params=params)
+        search_data = response.json()
+        metrics.annotate(payload_bytes=len(response.content))
+    except requests.exceptions.RequestException as e:
+        # Timeouts and unreadable answers fall back to the default place below, without caching it
+        print(f"Error searching Places API for query: {query}: {e}")
+        search_data = {'status': type(e).__name__}
+    places = search_data.get('results', [])
+    cacheable = search_data.get('status') in ('OK', 'ZERO_RESULTS')
+    if not cacheable:
+        metrics.annotate(error=search_data.get('status'))
 
     # Create a default place details dictionary
     default_place = {
@@ -31,17 +106,21 @@ def get_place_details(query, location, radius=5000, min_rating=2.5, min_reviews=
 
     if not places:
         # print(f"No places found for query: {query}")
-        return default_place
+        return default_place, cacheable
 
     # Filter places by minimum rating and minimum number of reviews
     filtered_places = [place for place in places if place.get('rating', 0) >= min_rating and place.get('user_ratings_total', 0) >= min_reviews]
 
     if not filtered_places:
         # print(f"No places found with a minimum rating of {min_rating} and a minimum of {min_reviews} reviews for query: {query}")
-        return default_place
+        return default_place, cacheable
 
-    # Sort places by number of reviews and rating
-    sorted_places = sorted(filtered_places, key=lambda x: (x.get('user_ratings_total', 0), x.get('rating', 0)), reverse=True)
+    # Sort places by number of reviews and rating. Matches known to lie outside the destination only
+    # win when nothing inside it matched, so a day trip the prompt allows is never replaced by the default
+    if len(filtered_places) > 1:
+        locate_destination(location)
+    sorted_places = sorted(filtered_places, key=lambda x: (within_destination({'location': x.get('geometry', {}).get('location')}, location) is not False,
+                                                           x.get('user_ratings_total', 0), x.get('rating', 0)), reverse=True)
     
     # Select the top place
     top_place = sorted_places[0]
@@ -51,23 +130,84 @@ def get_place_details(query, location, radius=5000, min_rating=2.5, min_reviews=
         "name": top_place['name'],
         "formatted_address": top_place['formatted_address'],
         "type": top_place['type'] if 'type' in top_place else 'NA',
-        "opening_hours": top_place['opening_hours'] if 'opening_hours' in top_place else {None},
+        "opening_hours": top_place['opening_hours'] if 'opening_hours' in top_place else {},
         "rating": top_place['rating'] if 'rating' in top_place else None,
         "user_ratings_total": top_place['user_ratings_total'] if 'user_ratings_total' in top_place else None,
-        "url": f"https://www.google.com/maps/search/{quote_plus(top_place['name'])}"
+        "url": f"https://www.google.com/maps/search/{quote_plus(top_place['name'])}",
+        "location": top_place.get('geometry', {}).get('location')
     }
 
+    details['weekly_hours'] = compile_opening_hours(details['opening_hours'])
+
     # Ensure all required fields are present
     for key in default_place.keys():
         if key not in details:
             details[key] = default_place[key]
 
-    return details
+    return details, cacheable
 
+def locate_destination(location):
+    # [lat, lng] centre of a location ("destination, country"), geocoded once and cached. None if it could not be geocoded
+    centre = destination_centre(location)
+    if centre is None:
+        centre, _ = destination_flight.do(normalize_query(location), geocode_destination, location)
+    return centre
+
+def geocode_destination(location):
+    # Only found locations are cached, a failed geocode is tried again by the next search
+    try:
+        places_limiter().acquire()
+        response = http_client.get(f"{config.MAPS_API_URL}/geocode/json", params={'address': location, 'key': config.maps_api_key()})
+        results = response.json().get('results') or []
+    except requests.exceptions.RequestException as e:
+        print(f"Error geocoding {location}: {e}")
+        return None
+    centre = place_coordinates({'location': results[0].get('geometry', {}).get('location')}) if results else None
+    if centre is not None:
+        set_destination_centre(location, *centre)
+    return centre
+
+def get_places_details(queries, location):
+    # Look up all queries at once, results come back in the same order as the queries
+    lookups = [metrics.submit(places_executor(), get_place_details, query, location) for query in queries]
+    return [lookup.result() for lookup in lookups]
+
+def submit_place_lookup(query, location):
+    # Start a single lookup on the shared pool, returns a future with the place details
+    return metrics.submit(places_executor(), get_place_details, query, location)
+
+@metrics.timed('weather', cached=True)
 @st.cache_data(ttl=3600,show_spinner=False)
+def get_weather_index(city):
+    # {date: summary} for the forecast days of the city, fetched at most once per WEATHER_CACHE_TTL
+    index = weather_cache().get(normalize_query(city))
+    if index is None:
+        index, shared = weather_flight.do(normalize_query(city), fetch_weather_index, city)
+        metrics.annotate(cache='coalesced' if shared else 'miss')
+    else:
+        metrics.annotate(cache='disk')
+    return index
+
+def fetch_weather_index(city):
+    weather_forecast_data = get_weather_forecast(city)
+    index = weather_index(weather_forecast_data)
+    weather_cache().set(normalize_query(city), index)
+    return index
+
+def get_weather_summary(weather_index, date):
+    return weather_index.get(date, WEATHER_UNAVAILABLE)
+
+def weather_index(weather_forecast_data):
+    return {day['date']: weather_summary(day['day']) for day in weather_forecast_data['forecast']['forecastday']}
+
+def weather_summary(day):
+    return f"{day['condition']['text']}: {day['maxtemp_c']}°C (max), {day['mintemp_c']}°C (min)"
+
 def get_weather_forecast(city):
-    url = f"https://api.weatherapi.com/v1/forecast.json?key={weather_api_key}&q={city}&days=14"
-    response = requests.get(url)
+    url = f"{config.WEATHER_API_URL}/forecast.json?key={config.weather_api_key()}&q={city}&days={WEATHER_FORECAST_DAYS}"
+    weather_limiter().acquire()
+    response = http_client.get(url)
+    metrics.annotate(payload_bytes=len(response.content))
 
     try:
         return response.json()
@@ -75,4 +215,59 @@ def get_weather_forecast(city):
         print(f"Error decoding JSON response from weather API for city: {city}")
         print(f"Response status code: {response.status_code}")
         print(f"Response content: {response.content}")
-        raise e
\ No newline at end of file
+        raise e
+
+def prefetch_weather(cities, refresh=False):
+    """
+    Warm the weather cache for many cities with weatherapi.com bulk requests, one request per
+    WEATHER_BULK_LIMIT cities not cached yet (every city with refresh). Returns {city: index}
+    for every city that is cached.
+    """
+    indexes = {}
+    # Spellings of the same city share one cache entry and are only requested once
+    spellings = {}
+    for city in cities:
+        spellings.setdefault(normalize_query(city), []).append(city)
+    missing = []
+    for key, names in spellings.items():
+        index = None if refresh else weather_cache().get(key)
+        if index is None:
+            missing.append(names[0])
+        else:
+            indexes.update(dict.fromkeys(names, index))
+
+    url = f"{config.WEATHER_API_URL}/forecast.json?key={config.weather_api_key()}&q=bulk&days={WEATHER_FORECAST_DAYS}"
+    for start in range(0, len(missing), WEATHER_BULK_LIMIT):
+        chunk = missing[start:start + WEATHER_BULK_LIMIT]
+        with metrics.span('weather') as span:
+            span.cache = 'miss'
+            try:
+                # Warm-up work, queued behind every lookup a user is waiting for
+                weather_limiter().acquire(PREFETCH)
+                response = http_client.post(url, json={'locations': [{'q': city, 'custom_id': str(i)} for i, city in enumerate(chunk)]})
+                span.payload_bytes = len(response.content)
+                results = response.json().get('bulk', [])
+            except requests.exceptions.RequestException as e:
+                print(f"Error prefetching weather for {len(chunk)} cities: {e}")
+                span.error = type(e).__name__
+                continue
+
+        for result in results:
+            query = result.get('query', {})
+            if 'forecast' not in query or not str(query.get('custom_id', '')).isdigit():
+                continue
+            key = normalize_query(chunk[int(query['custom_id'])])
+            index = weather_index(query)
+            weather_cache().set(key, index)
+            indexes.update(dict.fromkeys(spellings[key], index))
+    return indexes
+
+@jobs.periodic('weather_warmup', 'WEATHER_WARMUP_INTERVAL')
+def warm_weather(job, period):
+    """
+    Periodic job: fetch again, ahead of time, the forecasts users have read that expire before the
+    next run, so the next trip to those destinations starts from the cache.
+    """
+    cities = weather_cache().keys_to_refresh(config.WEATHER_WARMUP_INTERVAL)
+    indexes = prefetch_weather(cities, refresh=True) if cities else {}
+    return {'cities': len(cities), 'refreshed': len(indexes)}
@@ -0,0 +1,136 @@
+import streamlit as st
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+import config
+import metrics
+
+# Lower values are served first: the version a user is looking at, then the rest of the trip, then warm-up jobs
+INTERACTIVE = 0
+BACKGROUND = 1
+PREFETCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', PREFETCH: 'prefetch'}
+
+# Priority of the calls made by the current task, follows the work into executor threads via metrics.submit()
+current_priority = contextvars.ContextVar('current_priority', default=BACKGROUND)
+
+# Every limiter created in this process, by name
+limiters = {}
+
+class RateLimiter:
+    """
+    Process-wide token bucket refilled at `rate` tokens per second up to `burst`. Callers without
+    a token wait in a priority queue (priority, then arrival order) instead of failing, so a burst
+    of sessions slows down rather than exceeding the upstream quota.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = []
+        self.max_waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        limiters[name] = self
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=None):
+        """Block until a token is available for this caller, returns the seconds waited."""
+        priority = current_priority.get() if priority is None else priority
+        entry = (priority, next(self._order))
+        start = time.monotonic()
+        with self._condition:
+            heapq.heappush(self.waiting, entry)
+            self.max_waiting = max(self.max_waiting, len(self.waiting))
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.waiting[0] == entry and self.tokens >= 1 and now >= self.paused_until:
+                    heapq.heappop(self.waiting)
+                    self.tokens -= 1
+                    break
+                if self.waiting[0] == entry:
+                    # Sleep until the next token (or the end of a pause) instead of polling
+                    delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+            waited = time.monotonic() - start
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self._condition.notify_all()
+
+        metrics.observe(f"{self.name}_queue", waited)
+        return waited
+
+    def pause(self, seconds):
+        # The upstream said slow down (429), hold every caller for a while
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            depth = {}
+            for priority, _ in self.waiting:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'queue_depth': len(self.waiting),
+                'queue_by_priority': depth,
+                'max_queue_depth': self.max_waiting,
+                'acquired': self.acquired,
+                'mean_wait_s': round(self.total_wait / self.acquired, 4) if self.acquired else 0.0,
+                'max_wait_s': round(self.max_wait, 4)
+            }
+
+@contextmanager
+def priority(value):
+    token = current_priority.set(value)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+def with_priority(value, func, *args, **kwargs):
+    # Run func with the given priority, e.g. as an executor task
+    with priority(value):
+        return func(*args, **kwargs)
+
+def limiter_stats():
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+# Created on first use at the rates the upstream quotas allow this process (config.GEMINI_RPM, PLACES_QPS...),
+# the burst is how many calls may go out back to back
+@st.cache_resource(show_spinner=False)
+def gemini_limiter():
+    return RateLimiter('gemini', config.GEMINI_RPM / 60, config.GEMINI_BURST)
+
+@st.cache_resource(show_spinner=False)
+def places_limiter():
+    return RateLimiter('places', config.PLACES_QPS, max(1, int(config.PLACES_QPS)))
+
+@st.cache_resource(show_spinner=False)
+def distance_matrix_limiter():
+    return RateLimiter('distance_matrix', config.DISTANCE_MATRIX_QPS, max(1, int(config.DISTANCE_MATRIX_QPS)))
+
+@st.cache_resource(show_spinner=False)
+def weather_limiter():
+    return RateLimiter('weather', config.WEATHER_QPS, max(1, int(config.WEATHER_QPS)))
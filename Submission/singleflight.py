@@ -0,0 +1,54 @@
+import copy
+import threading
+from concurrent.futures import Future
+
+# Every single-flight group created in this process, by name
+groups = {}
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is in flight, other callers with
+    the same key wait for it and share its result or exception instead of calling again.
+    Waiting callers get a copy of the result, so sessions never share mutable objects. Nothing is
+    kept once the call finishes, caching stays with the caller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        groups[name] = self
+
+    def do(self, key, func, *args, **kwargs):
+        """Run func(*args, **kwargs) unless a call for key is already running. Returns (result, shared)."""
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                self.calls += 1
+                call = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return copy.deepcopy(call.result()), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+def coalesced_stats():
+    return {name: group.stats() for name, group in groups.items()}
@@ -1,11 +1,20 @@
 import streamlit as st
-import pycountry
 from datetime import datetime, timedelta, date
-import traceback
-from output import display_itinerary, send_to_gsheets, send_email
-from create_itinerary import create_travel_itinerary, create_night_itinerary
-import time
-import pandas as pd
+import json
+import config
+from output import display_itinerary, itinerary_markdown, rendered_itinerary, create_itinerary_set_pdf, queue_export
+from create_itinerary import collect_itineraries, ITINERARY_VERSIONS
+import metrics
+import http_client
+from travel_estimate import estimator_accuracy
+from singleflight import coalesced_stats
+from rate_limit import limiter_stats
+import jobs
+from itinerary_model import compact_versions, interned_places
+from pdf_engine import pdf_cache_stats
+
+# Most recent entries kept in the message history
+MAX_MESSAGES = 50
 
 def format_date(date_string):
     # Parse the input date string
@@ -62,8 +71,17 @@ def streamlit_pageconfig():
     if 'button_clicked' not in st.session_state:
         st.session_state.button_clicked = False
 
-    # List of all countries
-countries = sorted([country.name for country in pycountry.countries])
+    if 'generation_job' not in st.session_state:
+        st.session_state.generation_job = None
+
+    if 'pending_exports' not in st.session_state:
+        st.session_state.pending_exports = []
+
+@st.cache_resource(show_spinner=False)
+def country_names():
+    # List of all countries, built once per process when the first page is drawn
+    import pycountry
+    return sorted([country.name for country in pycountry.countries])
 
 def streamlit_page():
     # Streamlit app
@@ -135,6 +153,7 @@ def streamlit_page():
     )
     st.session_state.email_address = email_address
 
+    countries = country_names()
     country = st.sidebar.selectbox("🏳️ Country", countries, index=countries.index(st.session_state.country) if st.session_state.country in countries else 0)
     st.session_state.country = country
 
@@ -208,163 +227,257 @@ def streamlit_page():
             with col2:
                 if st.session_state.all_generated_itineraries:
                     if st.button("Email All Itineraries", key="export_all_itineraries"):
-                        if not email_address:
-                            st.error("Error: Please enter your email address.")
-                        if send_to_gsheets(email_address,destination,start_date,end_date):
-                            arguments = ['V1','V2','V3']
-                            send_email(arguments)
-                            st.sidebar.success("Most recent itinerary set exported successfully!")
-                        else:
-                            st.sidebar.error("No itineraries to export. Please generate an itinerary first.")
+                        queue_export(['V1','V2','V3'], email_address, destination, start_date, end_date, "Most recent itinerary set exported successfully!")
             
     if st.session_state.button_clicked:
-        with st.spinner("Generating itinerary, please wait..."):
-            try:
-                start_time = time.time()
-                new_day_itineraries = create_travel_itinerary(
-                    destination, country, start_date.strftime("%Y-%m-%d"), 
-                    end_date.strftime("%Y-%m-%d"), hotel_name, purpose_of_stay, 
-                    mode_of_transport_value, custom_preferences
-                )
-                day_time = time.time() - start_time
-
-                new_night_itineraries = None
-                if st.session_state.generate_nightlife:
-                    new_night_itineraries = create_night_itinerary(
-                        destination, country, start_date.strftime("%Y-%m-%d"), 
-                        end_date.strftime("%Y-%m-%d"), hotel_name, purpose_of_stay, 
-                        mode_of_transport_value, custom_preferences
-                    )
-                
-                st.session_state.all_generated_itineraries.append({
-                    'trip_details': {
-                        'destination': destination,
-                        'country': country,
-                        'start_date': start_date.strftime("%Y-%m-%d"),
-                        'end_date': end_date.strftime("%Y-%m-%d"),
-                        'hotel_name': hotel_name,
-                        'purpose_of_stay': purpose_of_stay,
-                        'mode_of_transport': mode_of_transport,
-                    },
-                    'day': new_day_itineraries,
-                    'night': new_night_itineraries
-                })
-                st.session_state.itinerary_set_count += 1
-                end_time = time.time()  # Stop the timer
-                elapsed_time = end_time - start_time  # Calculate elapsed time
-                #st.markdown(elapsed_time)
-                st.success(f"Itinerary set {st.session_state.itinerary_set_count} generated successfully!")
-
-            except Exception as e:
-                st.sidebar.error(f"An error occurred while creating the itinerary: {str(e)}")
-                st.sidebar.error(f"Exception type: {type(e)}")
-                st.sidebar.error(f"Exception traceback: {traceback.format_exc()}")
-
+        # Generation runs in a background job, the page only polls it, so reruns don't interrupt or repeat it
+        st.session_state.generation_job = {
+            'id': jobs.submit(
+                'itineraries', destination, country, start_date.strftime("%Y-%m-%d"),
+                end_date.strftime("%Y-%m-%d"), hotel_name, purpose_of_stay,
+                mode_of_transport_value, custom_preferences, st.session_state.generate_nightlife
+            ),
+            'trip_details': {
+                'destination': destination,
+                'country': country,
+                'start_date': start_date.strftime("%Y-%m-%d"),
+                'end_date': end_date.strftime("%Y-%m-%d"),
+                'hotel_name': hotel_name,
+                'purpose_of_stay': purpose_of_stay,
+                'mode_of_transport': mode_of_transport,
+            },
+            'nightlife': st.session_state.generate_nightlife
+        }
         st.session_state.button_clicked = False
 
+    if st.session_state.generation_job is not None:
+        job = jobs.poll(st.session_state.generation_job['id'])
+        if job is None or job['status'] in jobs.FINISHED:
+            finish_generation_job(job)
+        else:
+            show_generation_job()
+
     if st.session_state.all_generated_itineraries:
-        # Create the table data
-        table_data = []        
         # Display the most recently generated itinerary set
         most_recent_set = st.session_state.all_generated_itineraries[-1]
         st.write("## Current Search Itineraries")
-        trip_details = most_recent_set.get('trip_details')
-        st.write(f"### 🔸 {trip_details['destination']}, {trip_details['country']}  |  {format_date(trip_details['start_date'])} to {format_date(trip_details['end_date'])}")
-
-
-        if isinstance(most_recent_set, dict):
-            day_itineraries = most_recent_set.get('day', [])
-            night_itineraries = most_recent_set.get('night') if st.session_state.generate_nightlife else None
-        else:
-            day_itineraries = most_recent_set
-            night_itineraries = None
-        
-        tab_labels = [f"Version {i+1}" for i in range(len(day_itineraries))]
-        tabs = st.tabs(tab_labels)
-        for itinerary_number, (tab, day_itinerary) in enumerate(zip(tabs, day_itineraries), 1):
-            with tab:
-                with st.expander("Itinerary Details", expanded=True):
-                    if st.session_state.generate_nightlife:
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            st.write("#### 🌇 Day Itinerary")
-                            day_data = display_itinerary(day_itinerary, st.session_state.itinerary_set_count, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date)
-                            table_data.extend(day_data)
-                        
-                        with col2:
-                            st.write("#### 🌃 Night Itinerary ")
-                            if night_itineraries and itinerary_number <= len(night_itineraries):
-                                night_itinerary = night_itineraries[itinerary_number - 1]
-                                night_data = display_itinerary(night_itinerary, st.session_state.itinerary_set_count, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date)
-                                table_data.extend(night_data)
-                            else:
-                                st.write("No nightlife itinerary for this day.")
-                    else:
-                        st.write("#### Day Itinerary")
-                        day_data = display_itinerary(day_itinerary, st.session_state.itinerary_set_count, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date)
-                        table_data.extend(day_data)
+        write_set_heading(most_recent_set)
+        show_itinerary_set(most_recent_set, st.session_state.itinerary_set_count, True, email_address, destination, start_date, end_date)
         st.markdown("""---""")
 
-
-        # Display all previously generated itinerary sets in reverse order
+        # Display all previously generated itinerary sets in reverse order, each only rendered once the user opens it
         if len(st.session_state.all_generated_itineraries) > 1:
             st.write("## Previously Generated Itineraries")
             for set_number, itinerary_set in reversed(list(enumerate(st.session_state.all_generated_itineraries[:-1], 1))):
-                trip_details = itinerary_set.get('trip_details')
-                st.write(f"### 🔸 {trip_details['destination']}, {trip_details['country']}  |  {format_date(trip_details['start_date'])} to {format_date(trip_details['end_date'])}")
-            
-                if isinstance(itinerary_set, dict):
-                    day_itineraries = itinerary_set.get('day', [])
-                    night_itineraries = itinerary_set.get('night') if st.session_state.generate_nightlife else None
+                write_set_heading(itinerary_set)
+                if st.toggle("Show itineraries", key=f"show_set_{set_number}"):
+                    show_itinerary_set(itinerary_set, set_number, False, email_address, destination, start_date, end_date)
+
+    # After the itineraries, so exports queued by their buttons in this run are polled too
+    if st.session_state.pending_exports:
+        finish_exports()
+        if st.session_state.pending_exports:
+            show_pending_exports()
+
+    if config.DEBUG_PANEL or st.query_params.get('debug') == '1':
+        show_debug_panel()
+
+def write_set_heading(itinerary_set):
+    trip_details = itinerary_set.get('trip_details')
+    st.write(f"### 🔸 {trip_details['destination']}, {trip_details['country']}  |  {format_date(trip_details['start_date'])} to {format_date(trip_details['end_date'])}")
+
+def show_itinerary_set(itinerary_set, set_number, expanded, email_address, destination, start_date, end_date):
+    # One tab per version, the markdown of every version is rendered once and reused on later reruns
+    day_itineraries = itinerary_set.get('day', [])
+    night_itineraries = itinerary_set.get('night') if st.session_state.generate_nightlife else None
+    mode_of_transport = itinerary_set['trip_details']['mode_of_transport']
+
+    tabs = st.tabs([f"Version {i+1}" for i in range(len(day_itineraries))])
+    for itinerary_number, (tab, day_itinerary) in enumerate(zip(tabs, day_itineraries), 1):
+        with tab:
+            with st.expander("Itinerary Details", expanded=expanded):
+                if st.session_state.generate_nightlife:
+                    col1, col2 = st.columns(2)
+
+                    with col1:
+                        st.write("#### 🌇 Day Itinerary")
+                        display_itinerary(day_itinerary, set_number, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date,
+                                          rendered_itinerary(itinerary_set, 'day', itinerary_number))
+
+                    with col2:
+                        st.write("#### 🌃 Night Itinerary ")
+                        if night_itineraries and itinerary_number <= len(night_itineraries):
+                            display_itinerary(night_itineraries[itinerary_number - 1], set_number, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date,
+                                              rendered_itinerary(itinerary_set, 'night', itinerary_number))
+                        else:
+                            st.write("No nightlife itinerary for this day.")
                 else:
-                    day_itineraries = itinerary_set
-                    night_itineraries = None
-                
-                # output_display_page(day_itineraries)
-                tab_labels = [f"Version {i+1}" for i in range(len(day_itineraries))]
-                tabs = st.tabs(tab_labels)
-                for itinerary_number, (tab, day_itinerary) in enumerate(zip(tabs, day_itineraries), 1):
-                    with tab:
-                        with st.expander(f"Itinerary Details", expanded=False):
-                            if st.session_state.generate_nightlife:
-                                col1, col2 = st.columns(2)
-                                
-                                with col1:
-                                    st.write("#### Day Itinerary")
-                                    day_data = display_itinerary(day_itinerary, set_number, itinerary_number, mode_of_transport,email_address,destination,start_date,end_date)
-                                    table_data.extend(day_data)
-                                
-                                with col2:
-                                    st.write("#### Night Itinerary")
-                                    if night_itineraries and itinerary_number <= len(night_itineraries):
-                                        night_itinerary = night_itineraries[itinerary_number - 1]
-                                        night_data = display_itinerary(night_itinerary, set_number, itinerary_number, mode_of_transport,email_address,destination,start_date,end_date)
-                                        table_data.extend(night_data)
-                                    else:
-                                        st.write("No nightlife itinerary for this day.")
-                            else:
-                                st.write("#### Day Itinerary")
-                                day_data = display_itinerary(day_itinerary, set_number, itinerary_number, mode_of_transport,email_address,destination,start_date,end_date)
-                                table_data.extend(day_data)
-        
-        # Add the generated itineraries to the message history
-        if st.session_state.all_generated_itineraries:
-            total_itineraries = sum(len(itinerary_set) for itinerary_set in st.session_state.all_generated_itineraries)
-            
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": f"Generated {len(st.session_state.all_generated_itineraries)} set(s) of itineraries for {destination}, {country}. Total itineraries: {total_itineraries}."
-        })
-
-        # Add the generated itineraries to the message history
-        if st.session_state.all_generated_itineraries:
-            total_itineraries = sum(len(itinerary_set) for itinerary_set in st.session_state.all_generated_itineraries)
-            
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": f"Generated {len(st.session_state.all_generated_itineraries)} set(s) of itineraries for {destination}, {country}. Total itineraries: {total_itineraries}."
-        })
+                    st.write("#### Day Itinerary")
+                    display_itinerary(day_itinerary, set_number, itinerary_number, mode_of_transport, email_address, destination, start_date, end_date,
+                                      rendered_itinerary(itinerary_set, 'day', itinerary_number))
+
+    if st.button("Export All Versions as PDF 📄", key=f"export_set_pdf_{set_number}"):
+        st.download_button(
+            label="Download PDF",
+            data=create_itinerary_set_pdf(itinerary_set, set_number),
+            file_name=f"itineraries_{set_number}.pdf",
+            mime="application/pdf",
+            key=f"download_set_pdf_{set_number}"
+        )
+
+def stage_table(summary):
+    import pandas as pd
+    rows = {stage: {**stats, 'cache': ", ".join(f"{result} {count}" for result, count in stats['cache'].items())} for stage, stats in summary.items()}
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def show_debug_panel():
+    # JSON of the last run, recorded by the job that generated it. pandas is only needed for these tables
+    import pandas as pd
+    run = st.session_state.get('last_run_metrics')
+    with st.sidebar.expander("🛠️ Debug: Timings"):
+        if run is not None:
+            last_run = json.loads(run)
+            st.write(f"**Last run:** {last_run['name']} in {last_run['elapsed_s']:.2f}s")
+            st.dataframe(stage_table(last_run['stages']))
+            st.download_button("Download run (JSON)", run, file_name="run_metrics.json", mime="application/json")
+        st.write(f"**Process:** {metrics.process_metrics.runs} run(s)")
+        st.dataframe(stage_table(metrics.process_metrics.summary()))
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("JSON", metrics.process_metrics.to_json(), file_name="metrics.json", mime="application/json")
+        with col2:
+            st.download_button("Prometheus", metrics.process_metrics.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+        pool_stats = http_client.pool_stats()
+        st.write(f"**HTTP:** {pool_stats['requests']} request(s), {pool_stats['retries']} retries, {pool_stats['timeouts']} timeouts, {pool_stats['connection_errors']} connection errors")
+        if pool_stats['hosts']:
+            st.dataframe(pd.DataFrame.from_dict(pool_stats['hosts'], orient='index'))
+        st.write("**Coalesced calls** (waited on an identical call in flight)")
+        st.dataframe(pd.DataFrame.from_dict(coalesced_stats(), orient='index'))
+        st.write("**Rate limits** (calls queued for quota, by priority)")
+        st.dataframe(pd.DataFrame.from_dict(limiter_stats(), orient='index'))
+        st.write(f"**Interned places:** {interned_places()}")
+        pdf_cache = pdf_cache_stats()
+        st.write(f"**PDF cache:** {pdf_cache['documents']} document(s), {pdf_cache['bytes'] / 1024:.0f} KB")
+        st.write("**Jobs:** " + ", ".join(f"{count} {status}" for status, count in jobs.job_stats().items()))
+        accuracy = estimator_accuracy()
+        if accuracy:
+            st.write("**Travel time estimator** (error against Distance Matrix results)")
+            st.dataframe(pd.DataFrame.from_dict(accuracy, orient='index'))
+
+@st.fragment(run_every=config.JOB_POLL_INTERVAL)
+def show_generation_job():
+    # Days are shown in their version tab as soon as the job has verified them
+    generation = st.session_state.generation_job
+    if generation is None:
+        return
+    job = jobs.poll(generation['id'])
+    if job is None or job['status'] in jobs.FINISHED:
+        # Rerun the whole page, which moves the result into the itinerary sets
+        st.rerun()
+
+    progress = job['progress'] or {}
+    mode_of_transport = generation['trip_details']['mode_of_transport']
+    st.write("## Generating Itineraries")
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        if job['status'] == jobs.QUEUED:
+            st.write("⏳ Waiting for a free worker...")
+        else:
+            st.write(f"⏳ Generating itinerary, please wait... {sum(len(days) for days in progress.values())} day(s) ready")
+    with col2:
+        if st.button("Cancel", key="cancel_generation"):
+            jobs.cancel(generation['id'])
+
+    day_versions = collect_itineraries(progress.get('day', []))
+    night_versions = collect_itineraries(progress.get('night', []))
+    tabs = st.tabs([f"Version {i+1}" for i in range(ITINERARY_VERSIONS)])
+    for tab, day_itinerary, night_itinerary in zip(tabs, day_versions, night_versions):
+        with tab:
+            if generation['nightlife']:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.write("#### 🌇 Day Itinerary")
+                    st.markdown(itinerary_markdown(day_itinerary, mode_of_transport), unsafe_allow_html=True)
+                with col2:
+                    st.write("#### 🌃 Night Itinerary ")
+                    st.markdown(itinerary_markdown(night_itinerary, mode_of_transport), unsafe_allow_html=True)
+            else:
+                st.write("#### Day Itinerary")
+                st.markdown(itinerary_markdown(day_itinerary, mode_of_transport), unsafe_allow_html=True)
+
+@st.fragment(run_every=config.EXPORT_POLL_INTERVAL)
+def show_pending_exports():
+    # Polls the exports running on the export thread, the whole page reruns to report them once one is done
+    pending = st.session_state.pending_exports
+    if any(export_outcome(export) is not None for export in pending):
+        st.rerun()
+    st.write(f"📧 Sending {len(pending)} export(s) to your email...")
+
+def export_outcome(export):
+    # None while the export is running, otherwise (sent, error)
+    if 'job' in export:
+        job = jobs.poll(export['job'])
+        if job is not None and job['status'] not in jobs.FINISHED:
+            return None
+        return (job is not None and job['status'] == jobs.DONE), job and job['error']
+    future = export['future']
+    if not future.done():
+        return None
+    if future.exception() is not None:
+        return False, future.exception()
+    return future.result(), None
+
+def finish_exports():
+    # Report the exports that are done, keep polling the others
+    pending = []
+    for export in st.session_state.pending_exports:
+        outcome = export_outcome(export)
+        if outcome is None:
+            pending.append(export)
+            continue
+        sent, error = outcome
+        if sent:
+            st.sidebar.success(export['success'])
+        elif error:
+            print(f"Export failed: {error}")
+            st.sidebar.error("Sending the itineraries failed, please try again.")
+        else:
+            st.sidebar.error("No itineraries to export. Please generate an itinerary first.")
+    st.session_state.pending_exports = pending
+
+def finish_generation_job(job):
+    # Move the result of the finished job into the itinerary sets, or report why there is none
+    generation = st.session_state.generation_job
+    st.session_state.generation_job = None
+    if job is None:
+        st.sidebar.error("The itinerary generation job was lost, please generate the itineraries again.")
+        return
+    if job['status'] == jobs.CANCELLED:
+        st.sidebar.info("Itinerary generation cancelled.")
+        return
+    if job['status'] == jobs.FAILED:
+        st.sidebar.error(f"An error occurred while creating the itinerary: {job['error'].strip().splitlines()[-1]}")
+        st.sidebar.error(f"Exception traceback: {job['error']}")
+        return
+
+    result = jobs.result(job['id'])
+    st.session_state.last_run_metrics = result['metrics']
+    st.session_state.all_generated_itineraries.append({
+        'trip_details': generation['trip_details'],
+        'day': compact_versions(result['day']),
+        'night': compact_versions(result['night'])
+    })
+    st.session_state.itinerary_set_count += 1
+    st.success(f"Itinerary set {st.session_state.itinerary_set_count} generated successfully!")
+
+    # Add the generated itineraries to the message history, once per set
+    trip_details = generation['trip_details']
+    total_itineraries = sum(len(itinerary_set['day']) + len(itinerary_set['night'] or []) for itinerary_set in st.session_state.all_generated_itineraries)
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": f"Generated {len(st.session_state.all_generated_itineraries)} set(s) of itineraries for {trip_details['destination']}, {trip_details['country']}. Total itineraries: {total_itineraries}."
+    })
+    del st.session_state.messages[:-MAX_MESSAGES]
 
 def button_click():
     st.session_state.button_clicked = True
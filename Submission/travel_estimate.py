@@ -0,0 +1,139 @@
+import streamlit as st
+import threading
+import time
+import config
+from disk_cache import DiskCache
+from place_index import distance_km
+
+# Uncalibrated model per mode: door to door speed in km/h over the road distance, and fixed
+# seconds added to every leg (waiting for transit, parking...)
+MODE_SPEEDS = {'driving': 25.0, 'walking': 4.8, 'bicycling': 14.0, 'transit': 18.0}
+MODE_OVERHEAD = {'driving': 120, 'walking': 0, 'bicycling': 60, 'transit': 300}
+# Road distance over straight-line distance
+ROUTE_DETOUR = 1.3
+
+# Cached Distance Matrix results needed per mode before the fitted model replaces the defaults
+MIN_CALIBRATION_SAMPLES = 20
+# Seconds the calibration read from disk is reused before being read again
+CALIBRATION_REFRESH = 60
+
+@st.cache_resource(show_spinner=False)
+def calibration_cache():
+    # Running regression sums per mode, fed by every Distance Matrix element that gets cached
+    return DiskCache('travel_calibration')
+
+_models = {}
+_lock = threading.Lock()
+
+def format_duration(seconds):
+    # Distance Matrix style text, marked with "~" as an estimate
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"~{minutes} min" if minutes == 1 else f"~{minutes} mins"
+    hours, minutes = divmod(minutes, 60)
+    return f"~{hours} hour{'s' if hours > 1 else ''} {minutes} mins"
+
+def empty_stats():
+    return {'n': 0, 'sx': 0.0, 'sy': 0.0, 'sxx': 0.0, 'sxy': 0.0, 'detour': 0.0, 'errors': 0, 'abs_pct_error': 0.0}
+
+def fit_model(mode_of_transport, stats):
+    """
+    Duration in seconds as overhead + seconds_per_km * straight-line km, least squares over the
+    calibration samples. Falls back to the default speed model when there are too few samples
+    or the fit is not physically sensible.
+    """
+    speed = MODE_SPEEDS.get(mode_of_transport, MODE_SPEEDS['driving'])
+    model = {
+        'overhead': MODE_OVERHEAD.get(mode_of_transport, 0),
+        'seconds_per_km': 3600 / speed * ROUTE_DETOUR,
+        'detour': ROUTE_DETOUR,
+        'calibrated': False
+    }
+    n = stats['n']
+    if n < MIN_CALIBRATION_SAMPLES:
+        return model
+    variance = n * stats['sxx'] - stats['sx'] ** 2
+    if variance <= 0:
+        return model
+    slope = (n * stats['sxy'] - stats['sx'] * stats['sy']) / variance
+    intercept = (stats['sy'] - slope * stats['sx']) / n
+    if slope > 0:
+        model.update(overhead=max(0.0, intercept), seconds_per_km=slope, detour=stats['detour'] / n, calibrated=True)
+    return model
+
+def model_for(mode_of_transport):
+    now = time.time()
+    with _lock:
+        cached = _models.get(mode_of_transport)
+        if cached is not None and cached[0] + CALIBRATION_REFRESH > now:
+            return cached[1]
+    model = fit_model(mode_of_transport, calibration_cache().get(mode_of_transport) or empty_stats())
+    with _lock:
+        _models[mode_of_transport] = (now, model)
+    return model
+
+def estimate(origin, destination, mode_of_transport):
+    """(straight-line km, road metres, seconds) between two (lat, lng) points, None without coordinates."""
+    if origin is None or destination is None:
+        return None
+    straight = distance_km(*origin, *destination)
+    model = model_for(mode_of_transport)
+    return straight, straight * model['detour'] * 1000, model['overhead'] + model['seconds_per_km'] * straight
+
+def estimate_element(origin, destination, mode_of_transport):
+    # A Distance Matrix element built from the estimate, flagged with "estimated"
+    result = estimate(origin, destination, mode_of_transport)
+    if result is None:
+        return None
+    _, metres, seconds = result
+    return {
+        "status": "OK",
+        "distance": {"text": f"~{metres / 1000:.1f} km", "value": int(metres)},
+        "duration": {"text": format_duration(seconds), "value": int(seconds)},
+        "estimated": True
+    }
+
+def is_short_leg(origin, destination):
+    return origin is not None and destination is not None and distance_km(*origin, *destination) < config.SHORT_LEG_KM
+
+def record_sample(origin, destination, mode_of_transport, element):
+    """Compare the current estimate with a Distance Matrix element and add it to the calibration."""
+    if origin is None or destination is None or 'duration' not in element or 'distance' not in element:
+        return
+    straight, _, predicted = estimate(origin, destination, mode_of_transport)
+    if straight < 0.01:
+        return
+    seconds = element['duration']['value']
+    # Read-modify-write without a transaction, concurrent writers may drop a sample now and then
+    stats = calibration_cache().get(mode_of_transport) or empty_stats()
+    stats['n'] += 1
+    stats['sx'] += straight
+    stats['sy'] += seconds
+    stats['sxx'] += straight * straight
+    stats['sxy'] += straight * seconds
+    stats['detour'] += element['distance']['value'] / 1000 / straight
+    if seconds > 0:
+        stats['errors'] += 1
+        stats['abs_pct_error'] += abs(predicted - seconds) / seconds
+    calibration_cache().set(mode_of_transport, stats)
+    with _lock:
+        # Refit on the next estimate so this process uses its own samples straight away
+        _models.pop(mode_of_transport, None)
+
+def estimator_accuracy():
+    # Mean absolute percentage error of the estimates against the Distance Matrix results seen so far, per mode
+    report = {}
+    for mode_of_transport in MODE_SPEEDS:
+        stats = calibration_cache().get(mode_of_transport)
+        if not stats:
+            continue
+        model = model_for(mode_of_transport)
+        report[mode_of_transport] = {
+            'samples': stats['n'],
+            'mape': round(stats['abs_pct_error'] / stats['errors'], 3) if stats['errors'] else None,
+            'calibrated': model['calibrated'],
+            'overhead_s': round(model['overhead'], 1),
+            'seconds_per_km': round(model['seconds_per_km'], 1),
+            'detour': round(model['detour'], 3)
+        }
+    return report
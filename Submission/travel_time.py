@@ -0,0 +1,176 @@
+import streamlit as st
+import requests
+import http_client
+import config
+import time
+from concurrent.futures import ThreadPoolExecutor
+from disk_cache import DiskCache
+import metrics
+from travel_estimate import estimate_element, is_short_leg, record_sample
+from singleflight import SingleFlight
+from rate_limit import distance_matrix_limiter
+from place_weather import normalize_query
+
+# The Distance Matrix API allows at most 25 origins or destinations and 100 elements per request
+MAX_PLACES_PER_REQUEST = 25
+MAX_LEGS_PER_REQUEST = 10
+# Legs sharing an origin (or a destination) are sent together as one row (or column) of the matrix,
+# so every billed element is used. Other legs can be sent as origins[i] -> destinations[i] with only
+# the diagonal read back, but Distance Matrix bills per element: n legs cost n x n elements for n
+# results. By default (DISTANCE_MATRIX_DIAGONAL_BATCH = 1) they go one per request, which costs the
+# same as looking them up one by one. The legs of a day mostly form a chain (A -> B -> C -> D), so
+# a day of n activities usually takes n - 1 requests; they are sent concurrently (see get_travel_times),
+# so a day waits about one round trip rather than n - 1
+def diagonal_batch_legs():
+    return min(MAX_LEGS_PER_REQUEST, max(1, config.DISTANCE_MATRIX_DIAGONAL_BATCH))
+
+@st.cache_resource(show_spinner=False)
+def distance_matrix_executor():
+    # At most DISTANCE_MATRIX_MAX_CONCURRENCY requests in flight, shared by every session in the process
+    return ThreadPoolExecutor(max_workers=config.DISTANCE_MATRIX_MAX_CONCURRENCY, thread_name_prefix='distance-matrix')
+
+@st.cache_resource(show_spinner=False)
+def travel_time_cache():
+    # Found (status OK) matrix elements keyed by origin, destination, mode and departure bucket
+    return DiskCache('travel_times', ttl=config.TRAVEL_TIME_CACHE_TTL, max_bytes=config.TRAVEL_TIME_CACHE_MAX_BYTES)
+
+# Identical requests from concurrent sessions share one call
+distance_matrix_flight = SingleFlight('distance_matrix')
+
+def departure_bucket(mode_of_transport, departure_time):
+    # Only transit durations depend on the departure time (weekday and hour), other modes share one bucket
+    if mode_of_transport == "transit":
+        return time.strftime('%a-%H', time.localtime(departure_time))
+    return "any"
+
+def travel_time_key(origin, destination, mode_of_transport, departure_time):
+    return f"{normalize_query(origin)}|{normalize_query(destination)}|{mode_of_transport}|{departure_bucket(mode_of_transport, departure_time)}"
+
+def matrix_requests(legs, indexes):
+    """
+    Split the legs at indexes into Distance Matrix requests, as (origins, destinations, cells)
+    where cells holds the (leg index, row, column) of every leg in the response.
+    """
+    batches = []
+    remaining = []
+    by_origin = {}
+    for i in indexes:
+        by_origin.setdefault(legs[i][0], []).append(i)
+    for origin, group in by_origin.items():
+        if len(group) == 1:
+            remaining.extend(group)
+            continue
+        for start in range(0, len(group), MAX_PLACES_PER_REQUEST):
+            chunk = group[start:start + MAX_PLACES_PER_REQUEST]
+            batches.append(([origin], [legs[i][1] for i in chunk], [(i, 0, column) for column, i in enumerate(chunk)]))
+
+    single = []
+    by_destination = {}
+    for i in sorted(remaining):
+        by_destination.setdefault(legs[i][1], []).append(i)
+    for destination, group in by_destination.items():
+        if len(group) == 1:
+            single.extend(group)
+            continue
+        for start in range(0, len(group), MAX_PLACES_PER_REQUEST):
+            chunk = group[start:start + MAX_PLACES_PER_REQUEST]
+            batches.append(([legs[i][0] for i in chunk], [destination], [(i, row, 0) for row, i in enumerate(chunk)]))
+
+    single.sort()
+    batch = diagonal_batch_legs()
+    for start in range(0, len(single), batch):
+        chunk = single[start:start + batch]
+        batches.append(([legs[i][0] for i in chunk], [legs[i][1] for i in chunk], [(i, position, position) for position, i in enumerate(chunk)]))
+    return batches
+
+def request_distance_matrix(params):
+    # Returns the response JSON (or an error status) and the response size
+    try:
+        distance_matrix_limiter().acquire()
+        response = http_client.get(f"{config.MAPS_API_URL}/distancematrix/json", params=params)
+        return response.json(), len(response.content)
+    except requests.exceptions.RequestException as e:
+        print(f"Error requesting travel times from Distance Matrix API: {e}")
+        return {"status": type(e).__name__}, 0
+
+def get_travel_times(legs, mode_of_transport, coordinates=None):
+    """
+    Look up the travel time of every (origin, destination, departure_time) leg. Legs found in the
+    travel time cache are answered locally, the rest are sent to Distance Matrix grouped by shared
+    origin or destination (see matrix_requests), all requests at once. Returns a (status, element) tuple per leg, in order,
+    where status is the request status and element the matrix element (None if missing).
+
+    `coordinates` holds the ((lat, lng), (lat, lng)) of each leg's ends, or None where unknown. It lets
+    the local estimator answer legs according to TRAVEL_ESTIMATOR; estimated elements carry "estimated".
+    """
+    results = [None] * len(legs)
+    coordinates = coordinates or [(None, None)] * len(legs)
+
+    batches = {}
+    for index, (origin, destination, departure_time) in enumerate(legs):
+        element = travel_time_cache().get(travel_time_key(origin, destination, mode_of_transport, departure_time))
+        # Only found routes are answered from the cache, NOT_FOUND entries stored by older versions are asked again
+        if element is not None and element.get("status") == "OK":
+            results[index] = ("OK", element)
+            metrics.count('distance_matrix', cache='disk')
+            continue
+        if config.TRAVEL_ESTIMATOR == 'primary' or (config.TRAVEL_ESTIMATOR == 'fallback' and is_short_leg(*coordinates[index])):
+            element = estimate_element(*coordinates[index], mode_of_transport)
+            if element is not None:
+                results[index] = ("OK", element)
+                metrics.count('distance_matrix', cache='estimate')
+                continue
+        batches.setdefault(departure_bucket(mode_of_transport, departure_time), []).append(index)
+
+    # The requests of a trip are independent, they run side by side and each waits for the quota
+    lookups = [metrics.submit(distance_matrix_executor(), lookup_matrix, legs, mode_of_transport, coordinates, bucket, *request)
+               for bucket, indexes in batches.items() for request in matrix_requests(legs, indexes)]
+    for lookup in lookups:
+        for i, result in lookup.result():
+            results[i] = result
+    return results
+
+def lookup_matrix(legs, mode_of_transport, coordinates, bucket, origins, destinations, cells):
+    # Send one Distance Matrix request, returns the (leg index, (status, element)) of every leg in cells
+    params = {
+        'origins': "|".join(origins),
+        'destinations': "|".join(destinations),
+        'mode': mode_of_transport,
+        'key': config.maps_api_key()
+    }
+    # Only transit durations depend on it, and every leg of a transit bucket leaves within the same hour
+    if mode_of_transport == "transit":
+        params['departure_time'] = legs[cells[0][0]][2]
+    flight_key = (params['origins'], params['destinations'], mode_of_transport, bucket)
+    with metrics.span('distance_matrix') as span:
+        (distance_data, span.payload_bytes), shared = distance_matrix_flight.do(flight_key, request_distance_matrix, params)
+        span.cache = 'coalesced' if shared else 'miss'
+        status = distance_data.get("status")
+        if status != "OK":
+            span.error = status
+    rows = distance_data.get("rows") or []
+
+    answers = []
+    for i, row, column in cells:
+        element = None
+        if status == "OK" and row < len(rows):
+            elements = rows[row].get("elements") or []
+            if column < len(elements):
+                element = elements[column]
+                # Only the caller that made the request stores and learns from it. Routes Google could not
+                # find are not stored, so they are estimated again below instead of answered as NOT_FOUND
+                if not shared and element.get("status") == "OK":
+                    origin, destination, departure_time = legs[i]
+                    travel_time_cache().set(travel_time_key(origin, destination, mode_of_transport, departure_time), element)
+                    record_sample(*coordinates[i], mode_of_transport, element)
+        result = (status, element)
+
+        # Failed requests and addresses Google could not place are estimated from coordinates instead
+        failed = status != "OK" or element is None or element.get("status") == "NOT_FOUND"
+        if failed and config.TRAVEL_ESTIMATOR != 'off':
+            estimated = estimate_element(*coordinates[i], mode_of_transport)
+            if estimated is not None:
+                result = ("OK", estimated)
+                metrics.count('distance_matrix', cache='estimate')
+        answers.append((i, result))
+    return answers